@@ -1,15 +1,24 @@
 import os
-import threading
-from flask import Flask, render_template, request, redirect, url_for, flash
-from db import insert_data, get_full_data, get_votes_full_data, get_pred_df,get_perfume_url
-from get_prediction import get_prediction
-from main import query_catalog_parser, update_data
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify
+from db import insert_data, get_votes_full_data, get_pred_df, get_pred_df_by_id, get_pred_batch_df
+from catalog import catalog_service
+from get_prediction import get_predictions, prediction_message
+from jobs import check_jobs
+from model_registry import model_registry
+from main import query_catalog_parser
+from metrics import CONTENT_TYPE, instrument_app, metrics_registry
 from log import setup_logging
-from models_training import train_model
+from training_scheduler import training_scheduler
+from recommendations import get_fresh_prediction, get_recommendations, predict_and_store
+from review_tone import review_tone_pipeline
 
 setup_logging()
 
 app = Flask(__name__)
+instrument_app(app)
+
+model_registry.add_rejection_listener(
+    lambda version, reason: training_scheduler.request('rejected models', mode='full'))
 
 secret_key = os.getenv('secret_key')
 app.secret_key = secret_key
@@ -17,12 +26,11 @@ app.secret_key = secret_key
 
 @app.route('/', methods=['GET', 'POST'])
 def home():
-    catalog_df = get_full_data()
     if request.method == 'POST':
         selected_perfume = request.form.get('selected_perfume')
         if selected_perfume:
             return redirect(url_for('check_perfume', perfume_name=selected_perfume))
-    return render_template('index.html', catalog_df=catalog_df)
+    return render_template('index.html')
 
 
 @app.route('/check/<perfume_name>', methods=['GET', 'POST'])
@@ -32,38 +40,55 @@ def check_perfume(perfume_name):
         previous_vote = votes_full_data[votes_full_data.full_name == perfume_name].vote.values[0]
         message = "You used to like it. If you've changed your mind, vote again" if previous_vote else "You used to dislike it. If you've changed your mind, vote again"
     else:
-        perfumes_data = get_pred_df(perfume_name)
-        if perfumes_data.empty:
-            update_data([get_perfume_url(perfume_name)])
-            perfumes_data = get_pred_df(perfume_name)
-        prediction = get_prediction(perfumes_data)
-        if prediction == 0:
-            message = 'You will barely like it...'
-        elif prediction == 1:
-            message = 'Likely, you would find it quite nice'
+        # The catalog resolves the name in memory, so the queries below only look up the id
+        perfume_id = catalog_service.get_perfume_id(perfume_name)
+        stored_prediction = get_fresh_prediction(perfume_name, perfume_id)
+        if stored_prediction is not None:
+            message = prediction_message(stored_prediction['probability'])
         else:
-            message = "Can't tell. I need more data"
+            perfumes_data = get_pred_df_by_id(perfume_id) if perfume_id is not None else get_pred_df(perfume_name)
+            if perfumes_data.empty:
+                job = check_jobs.submit(perfume_name)
+                return render_template('check.html', perfume_name=perfume_name, job_id=job['id'],
+                                       message=f'Looking up {perfume_name}. This can take a minute...')
+            predictions = predict_and_store(perfumes_data, early_exit=True)
+            message = prediction_message(predictions['probability'].iloc[0])
 
     return render_template('check.html', perfume_name=perfume_name, message=message)
 
 
+@app.route('/check/status/<job_id>', methods=['GET'])
+def check_status(job_id):
+    job = check_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify({'status': job['status'], 'message': job['message']})
+
+
 @app.route('/vote', methods=['GET', 'POST'])
 def vote():
-    catalog_df = get_full_data()
     if request.method == 'POST':
         perfume_vote_selection = request.form.getlist('perfume_vote_selection')
         vote_type = request.form.get('vote_type')
         vote = True if vote_type == 'like' else False
 
+        voted_perfumes = []
+        insert_list = []
         for perfume in perfume_vote_selection:
-            perfume_id = int(catalog_df[catalog_df['full_name'] == perfume]['perfume_id'].values[0])
-            insert_data('my_votes', [[perfume_id, vote]])
-
-        threading.Thread(target=train_model).start()
-        flash(f'Your vote for {", ".join(perfume_vote_selection)} is added')
+            perfume_id = catalog_service.get_perfume_id(perfume)
+            if perfume_id is None:
+                flash(f"Can't find {perfume}")
+                continue
+            insert_list.append([perfume_id, vote])
+            voted_perfumes.append(perfume)
+
+        if voted_perfumes:
+            insert_data('my_votes', insert_list)
+            training_scheduler.request('vote')
+            flash(f'Your vote for {", ".join(voted_perfumes)} is added')
         return redirect(url_for('vote'))
 
-    return render_template('vote.html', catalog_df=catalog_df)
+    return render_template('vote.html')
 
 
 @app.route('/add', methods=['POST'])
@@ -84,5 +109,94 @@ def add_perfume():
     return redirect(url_for('home'))
 
 
+@app.route('/api/search', methods=['GET'])
+def search():
+    query = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+    full_names, more = catalog_service.search(query, page=page)
+    return jsonify({
+        'results': [{'id': full_name, 'text': full_name} for full_name in full_names],
+        'pagination': {'more': more},
+    })
+
+
+@app.route('/recommendations', methods=['GET'])
+def recommendations():
+    limit = request.args.get('n', 20, type=int)
+    recommendations_df = get_recommendations(limit=max(1, min(limit, 500)))
+    return render_template('recommendations.html', recommendations_df=recommendations_df)
+
+
+@app.route('/api/recommendations', methods=['GET'])
+def recommendations_api():
+    limit = request.args.get('n', 20, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    recommendations_df = get_recommendations(limit=max(1, min(limit, 500)), offset=max(0, offset))
+    recommendations_df['updated_at'] = recommendations_df['updated_at'].astype(str)
+    return jsonify(recommendations_df.to_dict(orient='records'))
+
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    payload = request.get_json(silent=True) or {}
+    full_names = payload.get('full_names') or []
+    perfume_ids = payload.get('perfume_ids') or []
+    brand_ids = payload.get('brand_ids') or []
+    if not all(isinstance(el, list) for el in [full_names, perfume_ids, brand_ids]):
+        return jsonify({'error': 'full_names, perfume_ids and brand_ids must be lists'}), 400
+    if not (full_names or perfume_ids or brand_ids):
+        return jsonify({'error': 'Provide full_names, perfume_ids or brand_ids'}), 400
+    try:
+        perfume_ids = [int(perfume_id) for perfume_id in perfume_ids]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'perfume_ids must be integers'}), 400
+
+    perfumes_data = get_pred_batch_df(full_names=full_names, perfume_ids=perfume_ids, brand_ids=brand_ids)
+    predictions = get_predictions(perfumes_data) if not perfumes_data.empty else None
+    found_names = set(perfumes_data['full_name'])
+    found_ids = set(perfumes_data['perfume_id'].astype(int))
+    return jsonify({
+        'version': predictions['version'].iloc[0] if predictions is not None else None,
+        'predictions': predictions.drop(columns='version').to_dict(orient='records') if predictions is not None else [],
+        'missing': [name for name in full_names if name not in found_names]
+                   + [perfume_id for perfume_id in perfume_ids if perfume_id not in found_ids],
+    })
+
+
+@app.route('/train', methods=['POST'])
+def train():
+    mode = request.args.get('mode', 'auto')
+    if mode not in ['auto', 'full', 'incremental']:
+        return jsonify({'error': 'mode must be auto, full or incremental'}), 400
+    training_scheduler.request('manual', mode=mode)
+    return jsonify(training_scheduler.get_status()), 202
+
+
+@app.route('/train/status', methods=['GET'])
+def train_status():
+    return jsonify(training_scheduler.get_status())
+
+
+@app.route('/reviews/tone', methods=['POST'])
+def score_review_tones():
+    reset = request.args.get('reset', '').lower() in ('1', 'true', 'yes')
+    return jsonify(review_tone_pipeline.start(reset=reset)), 202
+
+
+@app.route('/reviews/tone/status', methods=['GET'])
+def review_tone_status():
+    return jsonify(review_tone_pipeline.get_status())
+
+
+@app.route('/models/stats', methods=['GET'])
+def models_stats():
+    return jsonify(model_registry.get_stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(metrics_registry.render(), content_type=CONTENT_TYPE)
+
+
 if __name__ == '__main__':
     app.run(debug=True)
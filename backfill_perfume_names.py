@@ -0,0 +1,12 @@
+import argparse
+
+from db import backfill_perfume_names
+from log import setup_logging
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Fill the perfume_names lookup table from perfumes_catalog')
+    argument_parser.add_argument('--batch-size', type=int, default=50000, help='Perfume ids per transaction')
+    args = argument_parser.parse_args()
+    setup_logging()
+    backfill_perfume_names(batch_size=args.batch_size)
@@ -0,0 +1,246 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from benchmarks.synthetic import generate_catalog, generate_pages, load_catalog, register_sqlite_functions
+
+
+results_dir = os.path.join(os.path.dirname(__file__), 'results')
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def measure(benchmark, size, items, run, repeat=3, trace_memory=True):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - started)
+    peak_memory_mb = None
+    if trace_memory:
+        # A separate traced run, tracemalloc slows allocations down too much to time the same run
+        tracemalloc.start()
+        try:
+            run()
+            peak_memory_mb = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+        finally:
+            tracemalloc.stop()
+    median = statistics.median(timings)
+    record = {
+        'benchmark': benchmark,
+        'size': size,
+        'items': items,
+        'repeat': repeat,
+        'latency_ms': {'median': round(median * 1000, 3), 'min': round(min(timings) * 1000, 3),
+                       'max': round(max(timings) * 1000, 3)},
+        'throughput_per_s': round(items / median, 3) if median > 0 else None,
+        'peak_memory_mb': peak_memory_mb,
+    }
+    print(f'{benchmark:<28} size={size:<8} items={items:<8} median={record["latency_ms"]["median"]:>12.3f}ms '
+          f'throughput={record["throughput_per_s"]}/s peak={peak_memory_mb}MB', file=sys.stderr)
+    return record, result
+
+
+def configure_environment(args, work_dir):
+    # The repository modules read their settings at import time, so this runs before any of them is imported
+    os.environ['ca_string'] = args.database_url or f'sqlite:///{os.path.join(work_dir, "catalog.db")}'
+    os.environ['dataset_snapshot_dir'] = os.path.join(work_dir, 'snapshot')
+    os.environ['training_source'] = 'snapshot'
+    os.environ['rf_trees'] = str(args.rf_trees)
+    os.environ['xgb_rounds'] = str(args.xgb_rounds)
+    if args.mongo_url:
+        os.environ['m_string'] = args.mongo_url
+        os.environ['mongo_db_name'] = args.mongo_db_name
+
+
+def install_models(model_registry, encoder, rf_model, xgb_model, engine=None):
+    # Without a MongoDB the registry is handed the freshly trained models, as if it had just downloaded them
+    model_registry._bundle = {'version': 'benchmark', 'trained_features': encoder.features, 'loaded_at': time.time(),
+                              'encoder': encoder, 'rf_model': rf_model, 'xgb_model': xgb_model, 'engine': engine}
+    model_registry.check_interval = float('inf')
+
+
+def run_size(size, args, work_dir):
+    import db
+    import get_prediction
+    import models_training
+    import parsers
+    import snapshot
+    import tree_engine
+    from bs4 import BeautifulSoup as bs
+    from model_registry import model_registry
+
+    records = []
+    catalog = generate_catalog(size, vote_fraction=args.vote_fraction, seed=args.seed)
+    started = time.perf_counter()
+    load_catalog(db.engine, db.metadata, db.table_schemas, catalog)
+    # The synthetic rows bypass bulk_insert, so the name lookup table is filled the way a migration would
+    db.backfill_perfume_names()
+    print(f'Synthetic catalog of {size} perfumes and {len(catalog["my_votes"])} votes loaded '
+          f'in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+    shutil.rmtree(os.path.join(work_dir, 'snapshot'), ignore_errors=True)
+    votes = len(catalog['my_votes'])
+
+    record, _ = measure('get_full_data', size, size, db.get_full_data, args.repeat)
+    records.append(record)
+
+    def prepare_from_database():
+        return models_training.data_prep(db.get_dataset_df())
+
+    record, (X, y, encoder) = measure('data_prep', size, votes, prepare_from_database, args.repeat)
+    records.append(record)
+
+    snapshot.build_snapshot()
+
+    def prepare_from_snapshot():
+        dataset = snapshot.update_snapshot()
+        return dataset.X, dataset.votes.astype(int)
+
+    record, _ = measure('data_prep_snapshot', size, votes, prepare_from_snapshot, args.repeat)
+    records.append(record)
+
+    if args.mongo_url:
+        record, _ = measure('train_model', size, votes, lambda: models_training.train_model('full'), 1,
+                            args.trace_training)
+        records.append(record)
+        model_registry.notify_published()
+        model_registry.get()
+    else:
+        record, (rf_model, _) = measure('train_rf', size, votes, lambda: models_training.RandomForest_result(X, y), 1,
+                                        args.trace_training)
+        records.append(record)
+        record, (xgb_model, _) = measure('train_xgb', size, votes, lambda: models_training.XGB_result(X, y), 1,
+                                         args.trace_training)
+        records.append(record)
+        record, path = measure('export_engine', size, votes,
+                               lambda: tree_engine.export_engine(rf_model, xgb_model, X, 'benchmark',
+                                                                 os.path.join(work_dir, 'engine')), 1, False)
+        records.append(record)
+        install_models(model_registry, encoder, rf_model, xgb_model, tree_engine.load_engine(path))
+
+    unvoted = size - votes
+
+    def score_unvoted():
+        return get_prediction.get_predictions(db.get_unvoted_pred_df())
+
+    record, _ = measure('get_predictions', size, unvoted, score_unvoted, args.repeat)
+    records.append(record)
+
+    rng = random.Random(args.seed)
+    brand_names = {brand['brand_id']: brand['brand_name'] for brand in catalog['brands']}
+    full_names = [f'{entry["perfume_name"]}, {brand_names[entry["brand_id"]]}'
+                  for entry in rng.sample(catalog['perfumes_catalog'], min(args.check_names, size))]
+
+    def check_perfumes():
+        return [get_prediction.get_prediction(db.get_pred_df(full_name)) for full_name in full_names]
+
+    record, _ = measure('get_prediction', size, len(full_names), check_perfumes, args.repeat)
+    records.append(record)
+
+    pages = generate_pages(catalog, args.pages, seed=args.seed)
+    parsers.main_url = parsers.main_url or 'https://www.example.com'
+    record, _ = measure('get_page_elements', size, len(pages),
+                        lambda: [parsers.get_page_elements(bs(page, 'html.parser')) for page in pages], args.repeat)
+    records.append(record)
+    record, _ = measure('get_page_elements_lxml', size, len(pages),
+                        lambda: [parsers.get_page_elements_lxml(page) for page in pages], args.repeat)
+    records.append(record)
+    return records
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'commit': commit}
+
+
+def compare(results, baseline, threshold):
+    baseline_latency = {(record['benchmark'], record['size']): record['latency_ms']['median']
+                        for record in baseline['results']}
+    regressions = []
+    for record in results:
+        previous = baseline_latency.get((record['benchmark'], record['size']))
+        if previous and record['latency_ms']['median'] > previous * (1 + threshold):
+            regressions.append({'benchmark': record['benchmark'], 'size': record['size'], 'baseline_ms': previous,
+                                'latency_ms': record['latency_ms']['median'],
+                                'slowdown': round(record['latency_ms']['median'] / previous, 2)})
+    return regressions
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='scent-benchmark-')
+    configure_environment(args, work_dir)
+    import db
+    register_sqlite_functions(db.engine)
+    records = []
+    try:
+        for size in args.sizes:
+            records.extend(run_size(size, args, work_dir))
+    finally:
+        if args.mongo_url:
+            from mongo import get_client
+            get_client().drop_database(args.mongo_db_name)
+        db.engine.dispose()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'environment': environment(),
+        'config': {'sizes': args.sizes, 'vote_fraction': args.vote_fraction, 'repeat': args.repeat,
+                   'rf_trees': args.rf_trees, 'xgb_rounds': args.xgb_rounds, 'pages': args.pages,
+                   'check_names': args.check_names, 'seed': args.seed,
+                   'database': 'postgresql' if args.database_url else 'sqlite', 'mongo': bool(args.mongo_url)},
+        'results': records,
+    }
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Benchmark the recommendation hot paths on synthetic catalogs')
+    argument_parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Catalog sizes in perfumes')
+    argument_parser.add_argument('--vote-fraction', type=float, default=0.02, help='Share of voted perfumes')
+    argument_parser.add_argument('--repeat', type=int, default=3)
+    argument_parser.add_argument('--rf-trees', type=int, default=200, help='Trees of the final forest')
+    argument_parser.add_argument('--xgb-rounds', type=int, default=200, help='Boosting rounds of the final XGBoost')
+    argument_parser.add_argument('--pages', type=int, default=200, help='Synthetic perfume pages to parse per size')
+    argument_parser.add_argument('--check-names', type=int, default=20, help='Perfumes checked one by one per size')
+    argument_parser.add_argument('--seed', type=int, default=42)
+    argument_parser.add_argument('--trace-training', action='store_true',
+                                 help='Also measure peak memory of training, which runs it twice')
+    argument_parser.add_argument('--database-url', default=None,
+                                 help='Throwaway PostgreSQL database, its tables are dropped. SQLite by default')
+    argument_parser.add_argument('--mongo-url', default=None,
+                                 help='Local MongoDB used to run the whole train_model and model loading')
+    argument_parser.add_argument('--mongo-db-name', default='scent_benchmark', help='Dropped after the run')
+    argument_parser.add_argument('--output', default=None, help='Results JSON, benchmarks/results/<timestamp>.json by default')
+    argument_parser.add_argument('--baseline', default=None, help='Previous results JSON to compare median latencies with')
+    argument_parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown against the baseline')
+    args = argument_parser.parse_args()
+    logging.disable(logging.INFO)
+
+    report = run(args)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            report['regressions'] = compare(report['results'], json.load(file), args.threshold)
+    output = args.output or os.path.join(results_dir, f'{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print(f'Results written to {output}', file=sys.stderr)
+    if report.get('regressions'):
+        print(json.dumps(report['regressions'], indent=2))
+        sys.exit(1)
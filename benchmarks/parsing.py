@@ -0,0 +1,52 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import statistics
+import time
+
+from bs4 import BeautifulSoup as bs
+
+import parsers
+
+
+pages_dir = os.path.join(os.path.dirname(__file__), 'pages')
+
+
+def time_parser(parse, html, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = parse(html)
+        timings.append(time.perf_counter() - started)
+    return result, timings
+
+
+def run(pages=pages_dir, repeat=20, main_url=None):
+    parsers.main_url = main_url or parsers.main_url or 'https://www.example.com'
+    results = []
+    for path in sorted(glob.glob(os.path.join(pages, '*.html'))):
+        with open(path, 'rb') as file:
+            html = file.read()
+        soup_result, soup_timings = time_parser(lambda page: parsers.get_page_elements(bs(page, 'html.parser')), html, repeat)
+        lxml_result, lxml_timings = time_parser(parsers.get_page_elements_lxml, html, repeat)
+        results.append({
+            'page': os.path.basename(path),
+            'bytes': len(html),
+            'same_result': soup_result == lxml_result,
+            'html_parser_ms': round(statistics.median(soup_timings) * 1000, 3),
+            'lxml_ms': round(statistics.median(lxml_timings) * 1000, 3),
+            'speedup': round(statistics.median(soup_timings) / statistics.median(lxml_timings), 2),
+        })
+    return results
+
+
+if __name__ == '__main__':
+    argument_parser = argparse.ArgumentParser(description='Compare html.parser and lxml perfume page parsing')
+    argument_parser.add_argument('--pages', default=pages_dir, help='Directory with saved perfume pages (*.html)')
+    argument_parser.add_argument('--repeat', type=int, default=20)
+    argument_parser.add_argument('--main-url', default=None, help='Site root used in note links of the saved pages')
+    args = argument_parser.parse_args()
+    logging.disable(logging.INFO)
+    print(json.dumps(run(args.pages, args.repeat, args.main_url), indent=2))
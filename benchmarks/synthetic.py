@@ -0,0 +1,128 @@
+import html
+import random
+
+import numpy as np
+from sqlalchemy import event, insert
+
+
+ACCORDS = ['woody', 'amber', 'warm spicy', 'vanilla', 'citrus', 'floral', 'white floral', 'fresh', 'aromatic',
+           'powdery', 'sweet', 'fruity', 'musky', 'green', 'leather', 'smoky', 'earthy', 'aquatic', 'balsamic',
+           'fresh spicy', 'rose', 'oud', 'iris', 'tobacco', 'honey', 'animalic', 'ozonic', 'herbal', 'soft spicy',
+           'coconut', 'lactonic', 'tropical', 'cherry', 'caramel', 'coffee', 'metallic', 'salty', 'mossy']
+
+SYLLABLES = ['ber', 'ga', 'mot', 'ce', 'dar', 'ton', 'ka', 'va', 'nil', 'la', 'pat', 'chou', 'li', 'ro', 'se', 'ja',
+             'smin', 'am', 'ber', 'gris', 'mu', 'sk', 've', 'ti', 'ver', 'san', 'dal', 'wo', 'od', 'ne', 'ro', 'li']
+
+REVIEW_WORDS = ['warm', 'cosy', 'sweet', 'fresh', 'linear', 'loud', 'soft', 'lasts', 'all', 'day', 'skin', 'opening',
+                'drydown', 'too', 'nice', 'bad', 'love', 'hate', 'the', 'a', 'on', 'after', 'hour', 'projection']
+
+
+def make_names(rng, count, prefix=''):
+    names = set()
+    while len(names) < count:
+        names.add(prefix + ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize())
+    return sorted(names)
+
+
+def zipf_weights(size, exponent=1.1):
+    # Note and perfumer frequencies in the real catalog have a long tail, so a few tokens dominate
+    return np.cumsum(1 / np.arange(1, size + 1) ** exponent).tolist()
+
+
+def generate_catalog(perfumes, vote_fraction=0.02, min_votes=100, notes=1500, perfumers=800, seed=42):
+    rng = random.Random(seed)
+    brand_names = make_names(rng, max(1, perfumes // 50))
+    perfumer_names = [f'{first} {last}' for first, last in
+                      zip(make_names(rng, perfumers), make_names(rng, perfumers, prefix='Mc'))]
+    note_names = make_names(rng, notes)
+    brands = [{'brand_id': f'b{i}', 'brand_name': name, 'brand_url': f'/designers/{name.replace(" ", "-")}.html'}
+              for i, name in enumerate(brand_names)]
+    perfumer_weights = zipf_weights(len(perfumer_names))
+    accord_weights = zipf_weights(len(ACCORDS), exponent=0.8)
+    note_weights = zipf_weights(len(note_names))
+    voted = set(rng.sample(range(1, perfumes + 1), min(perfumes, max(min_votes, int(perfumes * vote_fraction)))))
+    catalog = []
+    data = []
+    votes = []
+    for perfume_id in range(1, perfumes + 1):
+        brand = brands[rng.randrange(len(brands))]
+        perfume_name = f'{rng.choice(SYLLABLES).capitalize()}{rng.choice(SYLLABLES)} {perfume_id}'
+        catalog.append({
+            'perfume_id': perfume_id,
+            'perfume_nickname': f'{perfume_name.replace(" ", "-")}-{perfume_id}',
+            'perfume_name': perfume_name,
+            'perfume_url': f'/perfume/{brand["brand_name"]}/{perfume_name.replace(" ", "-")}-{perfume_id}.html',
+            'brand_id': brand['brand_id'],
+        })
+        data.append({
+            'perfume_id': perfume_id,
+            'perfumer': ','.join(sorted(set(rng.choices(perfumer_names, cum_weights=perfumer_weights,
+                                                        k=rng.randint(1, 2))))),
+            'accords': ','.join(sorted(set(rng.choices(ACCORDS, cum_weights=accord_weights, k=rng.randint(3, 8))))),
+            'notes': ','.join(sorted(set(rng.choices(note_names, cum_weights=note_weights, k=rng.randint(5, 20))))),
+            'rating': round(rng.uniform(2.5, 4.8), 2),
+            'votes_number': rng.randint(5, 20000),
+        })
+        if perfume_id in voted:
+            # Alternating labels keep both classes in every cross-validation fold
+            votes.append({'perfume_id': perfume_id, 'vote': len(votes) % 2 == 0})
+    return {'brands': brands, 'perfumes_catalog': catalog, 'perfumes_data': data, 'my_votes': votes}
+
+
+def register_sqlite_functions(engine):
+    # CONCAT only exists in SQLite 3.44+, the queries in db.py use it for full names
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def add_concat(dbapi_connection, connection_record):
+        dbapi_connection.create_function(
+            'CONCAT', -1, lambda *values: ''.join('' if value is None else str(value) for value in values),
+            deterministic=True)
+
+
+def load_catalog(engine, metadata, table_schemas, catalog, chunk_size=5000):
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        for table_name in ['brands', 'perfumes_catalog', 'perfumes_data', 'my_votes']:
+            rows = catalog[table_name]
+            for start in range(0, len(rows), chunk_size):
+                connection.execute(insert(table_schemas[table_name]), rows[start:start + chunk_size])
+
+
+def render_perfume_page(perfume, brand_name, reviews, main_url='https://www.example.com'):
+    accords = ''.join(f'<div class="cell accord-box"><div class="accord-bar">{html.escape(accord)}</div></div>'
+                      for accord in perfume['accords'].split(','))
+    perfumers = ''.join(f'<div><a href="/noses/{html.escape(name.replace(" ", "-"))}.html">{html.escape(name)}</a></div>'
+                        for name in perfume['perfumer'].split(','))
+    notes = ''.join(f'<div><a href="{main_url}/notes/{html.escape(note.replace(" ", "-"))}-{i}.html">'
+                    f'<img src="/n/{i}.jpg" alt="{html.escape(note)}"></a>{html.escape(note)}</div>'
+                    for i, note in enumerate(perfume['notes'].split(',')))
+    reviews_html = ''.join(
+        f'<div class="fragrance-review-box" itemprop="review">'
+        f'<div class="flex-container"><b class="idLinkify" title="/member/{reviewer_id}">user{reviewer_id}</b></div>'
+        f'<div itemprop="reviewBody"><p>{html.escape(review)}</p></div></div>'
+        for reviewer_id, review in reviews)
+    return (f'<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8">'
+            f'<title>{html.escape(perfume["perfume_name"])} by {html.escape(brand_name)}</title></head><body>'
+            f'<div class="grid-x">{accords}</div>'
+            f'<p class="info-note">Perfume rating <span>{perfume["rating"]}</span> out of <span>5</span> with '
+            f'<span>{perfume["votes_number"]:,}</span> votes</p>'
+            f'<div class="grid-x grid-padding-x"><div class="cell small-12"><span>Perfumers</span></div>'
+            f'<div class="cell small-12">{perfumers}</div></div>'
+            f'<div id="pyramid">{notes}</div>'
+            f'<div id="all-reviews">{reviews_html}</div></body></html>').encode('utf-8')
+
+
+def generate_pages(catalog, count, max_reviews=50, seed=42):
+    rng = random.Random(seed)
+    brand_names = {brand['brand_id']: brand['brand_name'] for brand in catalog['brands']}
+    pages = []
+    for perfume, entry in rng.sample(list(zip(catalog['perfumes_data'], catalog['perfumes_catalog'])),
+                                     min(count, len(catalog['perfumes_data']))):
+        reviews = [(rng.randint(1000, 999999), ' '.join(rng.choices(REVIEW_WORDS, k=rng.randint(5, 80))))
+                   for _ in range(rng.randint(0, max_reviews))]
+        pages.append(render_perfume_page(dict(perfume, perfume_name=entry['perfume_name']),
+                                         brand_names[entry['brand_id']], reviews))
+    return pages
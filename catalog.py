@@ -0,0 +1,197 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+import pandas as pd
+
+from db import get_full_data, add_insert_listener
+
+
+logger = logging.getLogger(__name__)
+
+
+catalog_ttl_seconds = float(os.getenv('catalog_ttl_seconds', 300))
+search_page_size = int(os.getenv('search_page_size', 30))
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    def __init__(self, entries=()):
+        # Entries are keyed by perfume id, names differing only in case are still separate perfumes
+        self._names = {}
+        self._keys = {}
+        self._sorted_keys = []
+        self._postings = defaultdict(set)
+        self.add(entries)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, perfume_id):
+        return perfume_id in self._names
+
+    def add(self, entries):
+        new_keys = []
+        for perfume_id, name in entries:
+            perfume_id = int(perfume_id)
+            if perfume_id in self._names:
+                continue
+            key = name.lower()
+            self._names[perfume_id] = name
+            self._keys[perfume_id] = key
+            new_keys.append((key, perfume_id))
+            for trigram in trigrams(f' {key} '):
+                self._postings[trigram].add(perfume_id)
+        if len(new_keys) > len(self._sorted_keys):
+            self._sorted_keys = sorted((key, perfume_id) for perfume_id, key in self._keys.items())
+        else:
+            for entry in new_keys:
+                bisect.insort(self._sorted_keys, entry)
+
+    def _prefix_matches(self, query):
+        start = bisect.bisect_left(self._sorted_keys, (query,))
+        matches = []
+        for key, perfume_id in self._sorted_keys[start:]:
+            if not key.startswith(query):
+                break
+            matches.append(perfume_id)
+        return matches
+
+    def _substring_matches(self, query):
+        postings = sorted((self._postings.get(trigram, set()) for trigram in trigrams(query)), key=len)
+        if not postings or not postings[0]:
+            return []
+        candidates = set.intersection(*postings)
+        matches = [perfume_id for perfume_id in candidates if query in self._keys[perfume_id]]
+        return sorted(matches, key=lambda perfume_id: self._rank(query, perfume_id))
+
+    def _similar_matches(self, query):
+        # Typo tolerance: rank names by the share of the query's trigrams they contain
+        query_trigrams = trigrams(f' {query} ')
+        counts = Counter()
+        for trigram in query_trigrams:
+            counts.update(self._postings.get(trigram, ()))
+        threshold = max(1, len(query_trigrams) // 2)
+        return [perfume_id for perfume_id, count in
+                sorted(counts.items(), key=lambda item: (-item[1], self._keys[item[0]], item[0])) if count >= threshold]
+
+    def _rank(self, query, perfume_id):
+        key = self._keys[perfume_id]
+        return not key.startswith(query), f' {query}' not in f' {key}', key, perfume_id
+
+    def search(self, query, offset=0, limit=search_page_size):
+        query = ' '.join(query.lower().split())
+        if not query:
+            page = [self._names[perfume_id] for _, perfume_id in self._sorted_keys[offset:offset + limit]]
+            return page, len(self._sorted_keys) > offset + limit
+        if len(query) == 1:
+            perfume_ids = self._prefix_matches(query)
+        elif len(query) == 2:
+            perfume_ids = sorted(self._postings.get(f' {query}', ()),
+                                 key=lambda perfume_id: self._rank(query, perfume_id))
+        else:
+            perfume_ids = self._substring_matches(query) or self._similar_matches(query)
+        page = [self._names[perfume_id] for perfume_id in perfume_ids[offset:offset + limit]]
+        return page, len(perfume_ids) > offset + limit
+
+
+class CatalogService:
+    def __init__(self, loader=get_full_data, ttl_seconds=catalog_ttl_seconds):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.RLock()
+        self._df = None
+        self._index = {}
+        self._brands = {}
+        self._search_index = SearchIndex()
+        self._loaded_at = None
+
+    def _is_stale(self):
+        return self._df is None or time.monotonic() - self._loaded_at >= self.ttl_seconds
+
+    def _set_catalog(self, df, search_index=None):
+        df = df.reset_index(drop=True)
+        index = dict(zip(df['full_name'], df['perfume_id'].astype(int)))
+        brands = dict(zip(df['brand_id'], df['brand_name']))
+        if search_index is None:
+            search_index = SearchIndex(zip(df['perfume_id'], df['full_name']))
+        self._df, self._index, self._search_index = df, index, search_index
+        self._brands.update({brand_id: brand_name for brand_id, brand_name in brands.items() if pd.notna(brand_name)})
+
+    def load(self):
+        with self._lock:
+            logger.info('Loading catalog')
+            self._set_catalog(self.loader())
+            self._loaded_at = time.monotonic()
+            logger.info(f'Catalog loaded: {len(self._df)} perfumes')
+
+    def _ensure_loaded(self):
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self.load()
+
+    def invalidate(self):
+        with self._lock:
+            self._df = None
+
+    def get_catalog_df(self):
+        self._ensure_loaded()
+        return self._df
+
+    def get_full_names(self):
+        return self.get_catalog_df()['full_name']
+
+    def get_perfume_id(self, full_name):
+        self._ensure_loaded()
+        return self._index.get(full_name)
+
+    def search(self, query, page=1, page_size=search_page_size):
+        self._ensure_loaded()
+        return self._search_index.search(query, offset=(page - 1) * page_size, limit=page_size)
+
+    def add_perfumes(self, insert_list):
+        with self._lock:
+            if self._df is None:
+                return
+            rows = []
+            for perfume_id, perfume_nickname, perfume_name, perfume_url, brand_id in insert_list:
+                brand_name = self._brands.get(brand_id)
+                if brand_name is None:
+                    # Full names need the brand name, which only a reload can provide
+                    logger.info(f'Unknown brand {brand_id}, catalog will be reloaded')
+                    self._df = None
+                    return
+                full_name = f'{perfume_name}, {brand_name}'
+                if int(perfume_id) not in self._search_index:
+                    rows.append({'perfume_id': int(perfume_id), 'perfume_nickname': perfume_nickname,
+                                 'perfume_name': perfume_name, 'perfume_url': perfume_url, 'brand_id': brand_id,
+                                 'brand_name': brand_name, 'full_name': full_name})
+            if rows:
+                df = pd.concat([self._df, pd.DataFrame(rows)], ignore_index=True)
+                self._search_index.add((row['perfume_id'], row['full_name']) for row in rows)
+                self._set_catalog(df.sort_values(['brand_name', 'perfume_name'], kind='stable'), self._search_index)
+                logger.info(f'{len(rows)} perfumes added to catalog')
+
+    def add_brands(self, insert_list):
+        with self._lock:
+            new_brands = {brand_id: brand_name for brand_id, brand_name, *_ in insert_list}
+            if self._df is not None and (self._df['brand_id'].isin(new_brands) & self._df['brand_name'].isna()).any():
+                self._df = None
+            self._brands.update(new_brands)
+
+    def on_insert(self, table_name, insert_list):
+        if table_name == 'perfumes_catalog':
+            self.add_perfumes(insert_list)
+        elif table_name == 'brands':
+            self.add_brands(insert_list)
+
+
+catalog_service = CatalogService()
+add_insert_listener(catalog_service.on_insert)
@@ -0,0 +1,100 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+from db import bulk_insert, get_brand_sync, get_catalog_perfume_ids
+from ingest import HostLimiter
+from parsers import get_brand_catalog, main_url
+
+
+logger = logging.getLogger(__name__)
+
+
+brand_sync_ttl_hours = float(os.getenv('brand_sync_ttl_hours', 24))
+brand_sync_workers = int(os.getenv('brand_sync_workers', 3))
+
+
+def brand_id(brand_data):
+    return brand_data[2].split('/')[2].replace('.html', '')
+
+
+def is_fresh(last_sync, ttl_hours=brand_sync_ttl_hours):
+    if last_sync is None:
+        return False
+    if last_sync.tzinfo is None:
+        last_sync = last_sync.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - last_sync < timedelta(hours=ttl_hours)
+
+
+def fetch_brand(brand_data, limiter):
+    host = urlparse(f'{main_url}{brand_data[2]}').netloc
+    with limiter.slot(host):
+        try:
+            perfumes = get_brand_catalog(brand_data)
+        except Exception as e:
+            logger.error(f'{brand_data[0]} catalog parsing raised {e}')
+            return None
+    return perfumes if isinstance(perfumes, list) else None
+
+
+def new_catalog_rows(perfumes, existing_ids):
+    rows = {}
+    for perfume in perfumes:
+        perfume_id = int(perfume[0])
+        if perfume_id not in existing_ids and perfume_id not in rows:
+            rows[perfume_id] = (perfume_id, *perfume[1:])
+    return list(rows.values())
+
+
+def sync_brands(brands_data, force=False, workers=brand_sync_workers, limiter=None, ttl_hours=brand_sync_ttl_hours):
+    brands = {brand_id(brand_data): brand_data for brand_data in brands_data}
+    sync_state = get_brand_sync(brands) if brands else {}
+    skipped = [] if force else [brand for brand in brands if is_fresh(sync_state.get(brand, (None,))[0], ttl_hours)]
+    to_fetch = {brand: brand_data for brand, brand_data in brands.items() if brand not in skipped}
+    for brand in skipped:
+        logger.info(f'{brands[brand][0]} was synced at {sync_state[brand][0]}, skipping')
+    summary = {'synced': [], 'skipped': skipped, 'failed': [], 'new_perfumes': 0}
+    if not to_fetch:
+        return summary
+
+    started = time.perf_counter()
+    limiter = limiter or HostLimiter()
+    catalogs = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='catalog-sync') as executor:
+        futures = {executor.submit(fetch_brand, brand_data, limiter): brand for brand, brand_data in to_fetch.items()}
+        for future in as_completed(futures):
+            brand = futures[future]
+            perfumes = future.result()
+            if perfumes is None:
+                summary['failed'].append(brand)
+            else:
+                catalogs[brand] = perfumes
+    if not catalogs:
+        return summary
+
+    # Only perfumes missing from the catalog are written, brands and their sync state go in the same transaction
+    existing_ids = get_catalog_perfume_ids(catalogs)
+    now = datetime.now(timezone.utc)
+    batches = {'brands': [], 'perfumes_catalog': [], 'brand_sync': []}
+    for brand, perfumes in catalogs.items():
+        brand_data = to_fetch[brand]
+        rows = new_catalog_rows(perfumes, existing_ids)
+        existing_ids.update(row[0] for row in rows)
+        batches['brands'].append((brand, brand_data[0], brand_data[2]))
+        batches['perfumes_catalog'].extend(rows)
+        batches['brand_sync'].append((brand, now, len({int(perfume[0]) for perfume in perfumes})))
+        logger.info(f'{brand_data[0]}: {len(perfumes)} perfumes on the brand page, {len(rows)} new')
+    try:
+        bulk_insert(batches)
+    except Exception as e:
+        logger.error(f'Writing the catalog of {", ".join(catalogs)} failed: {e}')
+        summary['failed'].extend(catalogs)
+        return summary
+    summary['synced'] = list(catalogs)
+    summary['new_perfumes'] = len(batches['perfumes_catalog'])
+    logger.info(f'Catalog sync finished in {time.perf_counter() - started:.1f}s: {len(summary["synced"])} brands synced, '
+                f'{len(skipped)} skipped, {len(summary["failed"])} failed, {summary["new_perfumes"]} new perfumes')
+    return summary
@@ -1,12 +1,15 @@
 import logging
 import os
+import threading
+from datetime import datetime, timezone
 
 import pandas as pd
-from sqlalchemy import text, create_engine, MetaData, Table, Column, Integer, String, Float, Boolean, ForeignKey, Index, insert
+from sqlalchemy import text, bindparam, select, update, delete, func, create_engine, inspect, MetaData, Table, Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Index
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 
+from metrics import db_query_seconds, db_rows_written, timed
+
 logger = logging.getLogger(__name__)
 
 
@@ -15,98 +18,236 @@ ca_string = os.getenv('ca_string')
 
 engine = create_engine(ca_string)
 
+insert_listeners = []
 
-def insert_data(table_name, insert_list, engine = engine):
-    logger.info(f'New data inserting into {table_name} started')
-
-    metadata = MetaData()
-
-    table_schemas = {
-        'brands': Table(
-            'brands', metadata,
-            Column('brand_id', String, primary_key=True),
-            Column('brand_name', String),
-            Column('brand_url', String)
-        ),
-        'my_votes': Table(
-            'my_votes', metadata,
-            Column('perfume_id', Integer, primary_key=True),
-            Column('vote', Boolean)
-        ),
-        'perfumes_catalog': Table(
-            'perfumes_catalog', metadata,
-            Column('perfume_id', Integer, primary_key=True),
-            Column('perfume_nickname', String),
-            Column('perfume_name', String),
-            Column('perfume_url', String),
-            Column('brand_id', String),
-            Index('idx_brand_id', 'brand_id'),
-            Index('idx_perfume_name', 'perfume_name'),
-            Index('idx_perfume_id_brand_id', 'perfume_id', 'brand_id')
-        ),
-        'perfumes_data': Table(
-            'perfumes_data', metadata,
-            Column('perfume_id', Integer, primary_key=True),
-            Column('perfumer', String),
-            Column('accords', String),
-            Column('notes', String),
-            Column('rating', Float),
-            Column('votes_number', Integer)
-        ),
-        'reviewers': Table(
-            'reviewers', metadata,
-            Column('reviewer_id', String, primary_key=True),
-            Column('reviewer', String)
-        ),
-        'reviews_data': Table(
-            'reviews_data', metadata,
-            Column('review_id', String, primary_key=True),
-            Column('perfume_id', Integer, ForeignKey('perfumes_catalog.perfume_id')),
-            Column('reviewer_id', String, ForeignKey('reviewers.reviewer_id')),
-            Column('review', String),
-            Column('review_tone', Boolean)
-        )
-    }
 
-    metadata.reflect(bind=engine)
+def add_insert_listener(listener):
+    insert_listeners.append(listener)
+
+
+def notify_insert_listeners(table_name, insert_list):
+    for listener in insert_listeners:
+        try:
+            listener(table_name, insert_list)
+        except Exception as e:
+            logger.error(f'Insert listener failed for {table_name}: {e}')
+
+
+metadata = MetaData()
+
+table_schemas = {
+    'brands': Table(
+        'brands', metadata,
+        Column('brand_id', String, primary_key=True),
+        Column('brand_name', String),
+        Column('brand_url', String)
+    ),
+    'my_votes': Table(
+        'my_votes', metadata,
+        Column('perfume_id', Integer, primary_key=True),
+        Column('vote', Boolean)
+    ),
+    'perfumes_catalog': Table(
+        'perfumes_catalog', metadata,
+        Column('perfume_id', Integer, primary_key=True),
+        Column('perfume_nickname', String),
+        Column('perfume_name', String),
+        Column('perfume_url', String),
+        Column('brand_id', String),
+        Index('idx_brand_id', 'brand_id'),
+        Index('idx_perfume_name', 'perfume_name'),
+        Index('idx_perfume_id_brand_id', 'perfume_id', 'brand_id')
+    ),
+    # Indexed "perfume name, brand name" keys, so name lookups do not concatenate and scan the whole catalog
+    'perfume_names': Table(
+        'perfume_names', metadata,
+        Column('full_name', String, primary_key=True),
+        Column('perfume_id', Integer, ForeignKey('perfumes_catalog.perfume_id'), primary_key=True),
+        Index('idx_perfume_names_perfume_id', 'perfume_id')
+    ),
+    'perfumes_data': Table(
+        'perfumes_data', metadata,
+        Column('perfume_id', Integer, primary_key=True),
+        Column('perfumer', String),
+        Column('accords', String),
+        Column('notes', String),
+        Column('rating', Float),
+        Column('votes_number', Integer)
+    ),
+    'reviewers': Table(
+        'reviewers', metadata,
+        Column('reviewer_id', String, primary_key=True),
+        Column('reviewer', String)
+    ),
+    'reviews_data': Table(
+        'reviews_data', metadata,
+        Column('review_id', String, primary_key=True),
+        Column('perfume_id', Integer, ForeignKey('perfumes_catalog.perfume_id')),
+        Column('reviewer_id', String, ForeignKey('reviewers.reviewer_id')),
+        Column('review', String),
+        Column('review_tone', Boolean),
+        Column('review_tone_scored_at', DateTime(timezone=True)),
+        Index('idx_reviews_data_unscored', 'review_id', postgresql_where=text('review_tone_scored_at IS NULL'))
+    ),
+    'predictions': Table(
+        'predictions', metadata,
+        Column('perfume_id', Integer, ForeignKey('perfumes_catalog.perfume_id'), primary_key=True),
+        Column('prediction', Float),
+        Column('probability', Float),
+        Column('model_version', String),
+        Column('updated_at', DateTime(timezone=True)),
+        Index('idx_predictions_probability', 'probability')
+    ),
+    'brand_sync': Table(
+        'brand_sync', metadata,
+        Column('brand_id', String, ForeignKey('brands.brand_id'), primary_key=True),
+        Column('last_sync', DateTime(timezone=True)),
+        Column('perfume_count', Integer)
+    )
+}
+
+# Tables whose rows replace existing ones on conflict; every other table keeps the first version of a row
+upsert_columns = {
+    'brands': ['brand_name', 'brand_url'],
+    'brand_sync': ['last_sync', 'perfume_count'],
+    'my_votes': ['vote'],
+    'predictions': ['prediction', 'probability', 'model_version', 'updated_at'],
+}
+
+# Parents first, so foreign keys are satisfied when several tables are written in one transaction
+insert_order = ['brands', 'perfumes_catalog', 'reviewers', 'perfumes_data', 'reviews_data', 'my_votes', 'predictions',
+                'brand_sync']
+
+insert_chunk_size = int(os.getenv('insert_chunk_size', 1000))
+
+_existing_tables = set()
+_tables_lock = threading.Lock()
 
-    if table_name not in metadata.tables:
-        logger.info(f'Table {table_name} does not exist. Creating it.')
-        if table_name in table_schemas:
-            table_schemas[table_name].create(engine)
-            metadata.create_all(engine)
-        else:
-            raise ValueError(f'Unknown table schema for {table_name}')
 
-    table = Table(table_name, metadata, autoload_with=engine)
+def ensure_table(table_name, engine=engine):
+    if table_name not in table_schemas:
+        raise ValueError(f'Unknown table schema for {table_name}')
+    if table_name in _existing_tables:
+        return table_schemas[table_name]
+    with _tables_lock:
+        if table_name not in _existing_tables:
+            if not inspect(engine).has_table(table_name):
+                logger.info(f'Table {table_name} does not exist. Creating it.')
+                metadata.create_all(engine)
+            _existing_tables.add(table_name)
+    return table_schemas[table_name]
 
-    Session = sessionmaker(bind=engine)
-    session = Session()
 
+def build_insert_statement(table_name, rows):
+    table = table_schemas[table_name]
+    stmt = insert(table).values(rows)
+    if table_name in upsert_columns:
+        return stmt.on_conflict_do_update(
+            index_elements=table.primary_key.columns.keys(),
+            set_={column: stmt.excluded[column] for column in upsert_columns[table_name]}
+        )
+    return stmt.on_conflict_do_nothing(index_elements=table.primary_key.columns.keys())
+
+
+def dedupe_rows(table_name, rows):
+    # ON CONFLICT DO UPDATE cannot touch the same row twice in one statement, so the last row per key wins
+    if table_name not in upsert_columns:
+        return list(rows)
+    key_positions = [list(table_schemas[table_name].columns.keys()).index(key)
+                     for key in table_schemas[table_name].primary_key.columns.keys()]
+    unique_rows = {}
+    for row in rows:
+        unique_rows[tuple(row[position] for position in key_positions)] = row
+    return list(unique_rows.values())
+
+
+@timed(db_query_seconds, 'query')
+def bulk_insert(batches, chunk_size=None, engine=engine):
+    chunk_size = chunk_size or insert_chunk_size
+    unknown_tables = [table_name for table_name in batches if table_name not in insert_order]
+    if unknown_tables:
+        raise ValueError(f'Unknown table type for {", ".join(unknown_tables)}')
+    batches = {table_name: dedupe_rows(table_name, rows) for table_name, rows in batches.items() if rows}
+    if not batches:
+        return
+    for table_name in batches:
+        ensure_table(table_name, engine)
+    if 'brands' in batches or 'perfumes_catalog' in batches:
+        ensure_table('perfume_names', engine)
+    logger.info('New data inserting started: '
+                + ', '.join(f'{len(rows)} rows into {table_name}' for table_name, rows in batches.items()))
     try:
-        if table_name in ['perfumes_catalog', 'brands', 'perfumes_data', 'reviewers', 'reviews_data']:
-            stmt = insert(table).values(insert_list)
-            stmt = stmt.on_conflict_do_nothing(
-                index_elements=[table.columns[table_schemas[table_name].primary_key.columns.keys()[0]]])
-        elif table_name == 'my_votes':
-            stmt = insert(table).values(insert_list)
-            stmt = stmt.on_conflict_do_update(
-                index_elements=['perfume_id'],
-                set_={'vote': stmt.excluded.vote}
-            )
-        else:
-            raise ValueError(f'Unknown table type for {table_name}')
-
-        session.execute(stmt)
-        session.commit()
+        with engine.begin() as connection:
+            for table_name in insert_order:
+                rows = batches.get(table_name, [])
+                for start in range(0, len(rows), chunk_size):
+                    connection.execute(build_insert_statement(table_name, rows[start:start + chunk_size]))
+            if 'brands' in batches or 'perfumes_catalog' in batches:
+                update_perfume_names(connection, perfume_ids=[row[0] for row in batches.get('perfumes_catalog', [])],
+                                     brand_ids=[row[0] for row in batches.get('brands', [])], chunk_size=chunk_size)
     except SQLAlchemyError as e:
-        session.rollback()
-        logger.error(f'Error inserting data into {table_name}: {e}')
+        logger.error(f'Error inserting data into {", ".join(batches)}: {e}')
         raise
-    finally:
-        session.close()
+    for table_name in insert_order:
+        if table_name in batches:
+            db_rows_written.inc(len(batches[table_name]), table=table_name)
+            notify_insert_listeners(table_name, batches[table_name])
+
+
+def update_perfume_names(connection, perfume_ids=(), brand_ids=(), chunk_size=None):
+    chunk_size = chunk_size or insert_chunk_size
+    names = table_schemas['perfume_names']
+    catalog = table_schemas['perfumes_catalog']
+    brands = table_schemas['brands']
+    perfume_ids = [int(perfume_id) for perfume_id in perfume_ids]
+    brand_ids = list(brand_ids)
+    # A renamed brand changes the full names of all its perfumes, so they are written again
+    for start in range(0, len(brand_ids), chunk_size):
+        connection.execute(delete(names).where(names.c.perfume_id.in_(
+            select(catalog.c.perfume_id).where(catalog.c.brand_id.in_(brand_ids[start:start + chunk_size])))))
+    conditions = ([catalog.c.brand_id.in_(brand_ids[start:start + chunk_size])
+                   for start in range(0, len(brand_ids), chunk_size)]
+                  + [catalog.c.perfume_id.in_(perfume_ids[start:start + chunk_size])
+                     for start in range(0, len(perfume_ids), chunk_size)])
+    for condition in conditions:
+        full_names = select(func.concat(catalog.c.perfume_name, ', ', brands.c.brand_name), catalog.c.perfume_id) \
+            .join_from(catalog, brands, catalog.c.brand_id == brands.c.brand_id).where(condition)
+        connection.execute(insert(names).from_select(['full_name', 'perfume_id'], full_names).on_conflict_do_nothing())
+
+
+def backfill_perfume_names(batch_size=50000, engine=engine):
+    ensure_table('perfumes_catalog', engine)
+    ensure_table('brands', engine)
+    ensure_table('perfume_names', engine)
+    catalog = table_schemas['perfumes_catalog']
+    with engine.connect() as connection:
+        first_id, last_id = connection.execute(select(func.min(catalog.c.perfume_id),
+                                                      func.max(catalog.c.perfume_id))).one()
+    if first_id is None:
+        logger.info('Catalog is empty, no perfume names to backfill')
+        return 0
+    names = table_schemas['perfume_names']
+    brands = table_schemas['brands']
+    written = 0
+    # One transaction per id range, so an interrupted backfill keeps its progress and can simply be run again
+    for start in range(first_id, last_id + 1, batch_size):
+        full_names = select(func.concat(catalog.c.perfume_name, ', ', brands.c.brand_name), catalog.c.perfume_id) \
+            .join_from(catalog, brands, catalog.c.brand_id == brands.c.brand_id) \
+            .where(catalog.c.perfume_id >= start, catalog.c.perfume_id < start + batch_size)
+        with engine.begin() as connection:
+            result = connection.execute(
+                insert(names).from_select(['full_name', 'perfume_id'], full_names).on_conflict_do_nothing())
+        written += max(result.rowcount, 0)
+        logger.info(f'Perfume names backfilled up to id {min(start + batch_size - 1, last_id)} of {last_id}')
+    logger.info(f'{written} perfume names backfilled')
+    return written
+
+
+def insert_data(table_name, insert_list, engine = engine):
+    bulk_insert({table_name: insert_list}, engine=engine)
 
 
+@timed(db_query_seconds, 'query')
 def get_full_data():
     query = '''
         SELECT p.*, b.brand_name, CONCAT(p.perfume_name, ', ', b.brand_name) AS full_name
@@ -118,7 +259,8 @@ def get_full_data():
     return df
 
 
-def get_dataset_df():
+@timed(db_query_seconds, 'query')
+def get_dataset_df(perfume_ids=None):
     query = '''
         SELECT c.perfume_name, p.*, b.brand_name, v.vote 
         FROM perfumes_data p
@@ -126,27 +268,89 @@ def get_dataset_df():
         INNER JOIN perfumes_catalog c ON p.perfume_id = c.perfume_id 
         INNER JOIN brands b ON b.brand_id = c.brand_id
     '''
-    df = pd.read_sql_query(query, con=engine)
+    if perfume_ids is None:
+        return pd.read_sql_query(query, con=engine)
+    query = text(query + ' WHERE p.perfume_id IN :perfume_ids').bindparams(bindparam('perfume_ids', expanding=True))
+    df = pd.read_sql_query(query, con=engine, params={'perfume_ids': [int(perfume_id) for perfume_id in perfume_ids]})
     return df
 
+
+@timed(db_query_seconds, 'query')
+def get_dataset_votes_df():
+    query = '''
+        SELECT v.perfume_id, v.vote, p.perfumer, p.notes, p.accords, b.brand_name
+        FROM my_votes v
+        INNER JOIN perfumes_data p ON p.perfume_id = v.perfume_id
+        INNER JOIN perfumes_catalog c ON p.perfume_id = c.perfume_id
+        INNER JOIN brands b ON b.brand_id = c.brand_id
+    '''
+    return pd.read_sql_query(query, con=engine)
+
+
+@timed(db_query_seconds, 'query')
 def get_pred_df(perfume_name):
+    ensure_table('perfume_names')
     query = text('''
         SELECT c.perfume_name, p.*, b.brand_name
-        FROM perfumes_data p 
+        FROM perfume_names n
+        INNER JOIN perfumes_data p ON p.perfume_id = n.perfume_id
         INNER JOIN perfumes_catalog c ON p.perfume_id = c.perfume_id 
         INNER JOIN brands b ON b.brand_id = c.brand_id 
-        WHERE CONCAT(c.perfume_name, ', ', b.brand_name) = :perfume_name;
+        WHERE n.full_name = :perfume_name;
     ''')
     df = pd.read_sql_query(query, con=engine, params={"perfume_name": perfume_name})
     return df
 
 
+@timed(db_query_seconds, 'query')
+def get_pred_df_by_id(perfume_id):
+    query = text('''
+        SELECT c.perfume_name, p.*, b.brand_name
+        FROM perfumes_data p 
+        INNER JOIN perfumes_catalog c ON p.perfume_id = c.perfume_id 
+        INNER JOIN brands b ON b.brand_id = c.brand_id 
+        WHERE p.perfume_id = :perfume_id;
+    ''')
+    df = pd.read_sql_query(query, con=engine, params={"perfume_id": int(perfume_id)})
+    return df
+
+
+@timed(db_query_seconds, 'query')
+def get_pred_batch_df(full_names=None, perfume_ids=None, brand_ids=None):
+    conditions = []
+    params = {}
+    if full_names:
+        ensure_table('perfume_names')
+        conditions.append('p.perfume_id IN (SELECT n.perfume_id FROM perfume_names n WHERE n.full_name IN :full_names)')
+        params['full_names'] = list(full_names)
+    if perfume_ids:
+        conditions.append('p.perfume_id IN :perfume_ids')
+        params['perfume_ids'] = [int(perfume_id) for perfume_id in perfume_ids]
+    if brand_ids:
+        conditions.append('c.brand_id IN :brand_ids')
+        params['brand_ids'] = list(brand_ids)
+    if not conditions:
+        raise ValueError('full_names, perfume_ids or brand_ids must be provided')
+    query = text(f'''
+        SELECT c.perfume_name, p.*, b.brand_name, CONCAT(c.perfume_name, ', ', b.brand_name) AS full_name
+        FROM perfumes_data p 
+        INNER JOIN perfumes_catalog c ON p.perfume_id = c.perfume_id 
+        INNER JOIN brands b ON b.brand_id = c.brand_id 
+        WHERE {' OR '.join(conditions)};
+    ''').bindparams(*[bindparam(name, expanding=True) for name in params])
+    df = pd.read_sql_query(query, con=engine, params=params)
+    logger.info(f'Prediction data for {len(df)} perfumes is ready')
+    return df
+
+
+@timed(db_query_seconds, 'query')
 def get_perfume_url(full_name):
+    ensure_table('perfume_names')
     query = text('''
         SELECT c.perfume_id, c.perfume_url 
-        FROM perfumes_catalog c 
-        INNER JOIN brands b ON c.brand_id = b.brand_id 
-        WHERE CONCAT(c.perfume_name, ', ', b.brand_name) = :full_name;
+        FROM perfume_names n
+        INNER JOIN perfumes_catalog c ON c.perfume_id = n.perfume_id
+        WHERE n.full_name = :full_name;
     ''')
     result = pd.read_sql_query(query, con=engine, params={"full_name": full_name}).values.tolist()
     if result:
@@ -155,6 +359,21 @@ def get_perfume_url(full_name):
         raise ValueError(f'No results found for {full_name}')
 
 
+@timed(db_query_seconds, 'query')
+def get_perfume_url_by_id(perfume_id):
+    query = text('''
+        SELECT c.perfume_id, c.perfume_url 
+        FROM perfumes_catalog c 
+        WHERE c.perfume_id = :perfume_id;
+    ''')
+    result = pd.read_sql_query(query, con=engine, params={"perfume_id": int(perfume_id)}).values.tolist()
+    if result:
+        return result[0]
+    else:
+        raise ValueError(f'No results found for perfume {perfume_id}')
+
+
+@timed(db_query_seconds, 'query')
 def get_votes_full_data():
     query = '''
         SELECT p.*, v.vote, CONCAT(p.perfume_name, ', ', b.brand_name) AS full_name
@@ -167,6 +386,139 @@ def get_votes_full_data():
     return df
 
 
+@timed(db_query_seconds, 'query')
+def get_unvoted_pred_df():
+    query = '''
+        SELECT c.perfume_name, p.*, b.brand_name, CONCAT(c.perfume_name, ', ', b.brand_name) AS full_name
+        FROM perfumes_data p 
+        INNER JOIN perfumes_catalog c ON p.perfume_id = c.perfume_id 
+        INNER JOIN brands b ON b.brand_id = c.brand_id 
+        LEFT JOIN my_votes v ON p.perfume_id = v.perfume_id
+        WHERE v.perfume_id IS NULL
+        ORDER BY p.perfume_id;
+    '''
+    df = pd.read_sql_query(query, con=engine)
+    logger.info(f'{len(df)} unvoted perfumes are ready for scoring')
+    return df
+
+
+@timed(db_query_seconds, 'query')
+def get_top_predictions(limit=20, offset=0):
+    ensure_table('predictions')
+    query = text('''
+        SELECT r.perfume_id, CONCAT(c.perfume_name, ', ', b.brand_name) AS full_name,
+               r.prediction, r.probability, r.model_version, r.updated_at
+        FROM predictions r
+        INNER JOIN perfumes_catalog c ON r.perfume_id = c.perfume_id
+        INNER JOIN brands b ON b.brand_id = c.brand_id
+        LEFT JOIN my_votes v ON r.perfume_id = v.perfume_id
+        WHERE v.perfume_id IS NULL
+        ORDER BY r.probability DESC
+        LIMIT :limit OFFSET :offset;
+    ''')
+    return pd.read_sql_query(query, con=engine, params={'limit': int(limit), 'offset': int(offset)})
+
+
+@timed(db_query_seconds, 'query')
+def get_stored_prediction(perfume_name):
+    ensure_table('predictions')
+    ensure_table('perfume_names')
+    query = text('''
+        SELECT r.perfume_id, r.prediction, r.probability, r.model_version, r.updated_at
+        FROM predictions r
+        INNER JOIN perfume_names n ON r.perfume_id = n.perfume_id
+        WHERE n.full_name = :perfume_name;
+    ''')
+    rows = pd.read_sql_query(query, con=engine, params={'perfume_name': perfume_name}).to_dict(orient='records')
+    return rows[0] if rows else None
+
+
+@timed(db_query_seconds, 'query')
+def get_stored_prediction_by_id(perfume_id):
+    ensure_table('predictions')
+    query = text('''
+        SELECT r.perfume_id, r.prediction, r.probability, r.model_version, r.updated_at
+        FROM predictions r
+        WHERE r.perfume_id = :perfume_id;
+    ''')
+    rows = pd.read_sql_query(query, con=engine, params={'perfume_id': int(perfume_id)}).to_dict(orient='records')
+    return rows[0] if rows else None
+
+
+@timed(db_query_seconds, 'query')
+def get_brand_sync(brand_ids):
+    ensure_table('brand_sync')
+    table = table_schemas['brand_sync']
+    # A table select rather than text, so last_sync comes back as a datetime on every backend
+    query = select(table.c.brand_id, table.c.last_sync, table.c.perfume_count).where(
+        table.c.brand_id.in_(list(brand_ids)))
+    with engine.connect() as connection:
+        rows = connection.execute(query).fetchall()
+    return {brand_id: (last_sync, perfume_count) for brand_id, last_sync, perfume_count in rows}
+
+
+@timed(db_query_seconds, 'query')
+def get_catalog_perfume_ids(brand_ids):
+    ensure_table('perfumes_catalog')
+    query = text('''
+        SELECT perfume_id
+        FROM perfumes_catalog
+        WHERE brand_id IN :brand_ids;
+    ''').bindparams(bindparam('brand_ids', expanding=True))
+    with engine.connect() as connection:
+        return {perfume_id for perfume_id, in connection.execute(query, {'brand_ids': list(brand_ids)})}
+
+
+def ensure_review_tone_scored_at(engine=engine):
+    table = ensure_table('reviews_data', engine)
+    # Tables created before reviews were scored lack the column, which create_all does not add
+    if 'review_tone_scored_at' not in {column['name'] for column in inspect(engine).get_columns('reviews_data')}:
+        logger.info('Adding review_tone_scored_at to reviews_data')
+        column_type = table.c.review_tone_scored_at.type.compile(dialect=engine.dialect)
+        with engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE reviews_data ADD COLUMN review_tone_scored_at {column_type}'))
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def stream_unscored_reviews(after=None, chunk_size=5000, engine=engine):
+    ensure_review_tone_scored_at(engine)
+    query = text('''
+        SELECT review_id, review
+        FROM reviews_data
+        WHERE review_tone_scored_at IS NULL AND review_id > :after
+        ORDER BY review_id;
+    ''')
+    # A server-side cursor, so only one chunk of reviews is held in memory at a time
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(
+            query, {'after': after or ''})
+        for chunk in result.partitions(chunk_size):
+            yield [tuple(row) for row in chunk]
+
+
+@timed(db_query_seconds, 'query')
+def update_review_tones(tones, chunk_size=None, engine=engine):
+    chunk_size = chunk_size or insert_chunk_size
+    if not tones:
+        return
+    table = table_schemas['reviews_data']
+    # Neutral reviews keep an empty tone but get a scored_at, so later runs do not score them again
+    stmt = update(table).where(table.c.review_id == bindparam('b_review_id')).values(
+        review_tone=bindparam('b_review_tone'), review_tone_scored_at=bindparam('b_scored_at'))
+    scored_at = datetime.now(timezone.utc)
+    try:
+        with engine.begin() as connection:
+            for start in range(0, len(tones), chunk_size):
+                connection.execute(stmt, [{'b_review_id': review_id, 'b_review_tone': tone, 'b_scored_at': scored_at}
+                                          for review_id, tone in tones[start:start + chunk_size]])
+    except SQLAlchemyError as e:
+        logger.error(f'Error updating review tones: {e}')
+        raise
+    db_rows_written.inc(len(tones), table='reviews_data')
+
+
+@timed(db_query_seconds, 'query')
 def get_table_df(table_name):
     return pd.read_sql_table(table_name, con=engine)
 
@@ -0,0 +1,77 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+logger = logging.getLogger(__name__)
+
+
+DESC_COLUMNS = ['perfumer', 'brand_name', 'notes', 'accords']
+
+
+def tokenize(df):
+    missing_columns = [col for col in DESC_COLUMNS + ['perfume_id'] if col not in df.columns]
+    if missing_columns:
+        raise ValueError(f'Input DataFrame must contain the following columns: {DESC_COLUMNS + ["perfume_id"]}')
+    desc = df[DESC_COLUMNS].fillna('').astype(str).agg(','.join, axis=1)
+    tokens = desc.str.lower().str.replace('[()-]', ' ', regex=True).str.split(',').explode().str.strip()
+    return tokens[tokens != '']
+
+
+class FeatureEncoder:
+    def __init__(self, features=None):
+        self.vocabulary = {token: i for i, token in enumerate(features or [])}
+
+    @classmethod
+    def from_features(cls, features):
+        encoder = cls()
+        for feature in features:
+            encoder.vocabulary.setdefault(feature, len(encoder.vocabulary))
+        return encoder
+
+    @property
+    def features(self):
+        return sorted(self.vocabulary, key=self.vocabulary.get)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def fit(self, df):
+        self.vocabulary = {token: i for i, token in enumerate(sorted(tokenize(df).unique()))}
+        logger.info(f'Feature vocabulary has {len(self.vocabulary)} tokens')
+        return self
+
+    def transform(self, df):
+        df = df.reset_index(drop=True)
+        perfume_codes, perfume_ids = pd.factorize(df['perfume_id'])
+        tokens = tokenize(df)
+        columns = tokens.map(self.vocabulary)
+        known = columns.notna().to_numpy()
+        rows = perfume_codes[tokens.index.to_numpy()][known]
+        matrix = sparse.csr_matrix(
+            (np.ones(known.sum(), dtype=np.float32), (rows, columns.to_numpy()[known].astype(np.int64))),
+            shape=(len(perfume_ids), len(self.vocabulary)),
+        )
+        matrix.sum_duplicates()
+        return matrix, np.asarray(perfume_ids)
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+
+def check_model_features(model_name, model, encoder, trained_features=None):
+    # A model scored with columns in another order or count gives wrong predictions without any error
+    booster_features = model.get_booster().feature_names if hasattr(model, 'get_booster') else None
+    if booster_features:
+        raise ValueError(f'{model_name} was fitted on named DataFrame columns and can not score the sparse features, '
+                         f'a full retrain is needed')
+    n_features = getattr(model, 'n_features_in_', None)
+    if n_features is not None and n_features != len(encoder):
+        raise ValueError(f'{model_name} expects {n_features} features but the published encoder has {len(encoder)}, '
+                         f'a full retrain is needed')
+    feature_names = getattr(model, 'feature_names_in_', None)
+    if feature_names is not None and trained_features is not None and list(feature_names) != list(trained_features):
+        raise ValueError(f'{model_name} was fitted on columns that differ from the published training features, '
+                         f'a full retrain is needed')
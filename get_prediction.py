@@ -1,58 +1,171 @@
 import logging
 import os
+
+import numpy as np
 import pandas as pd
-import joblib
-from pymongo import MongoClient
-import gridfs
-import io
+from scipy import sparse
+from sklearn.linear_model import LogisticRegression
+from metrics import prediction_seconds, timed
+from model_registry import model_registry
 
 
 logger = logging.getLogger(__name__)
 
 
-m_string = os.getenv('m_string')
+model_weights = {
+    'rf_model': float(os.getenv('rf_weight', 0.5)),
+    'xgb_model': float(os.getenv('xgb_weight', 0.5)),
+}
+like_threshold = float(os.getenv('like_threshold', 0.6))
+dislike_threshold = float(os.getenv('dislike_threshold', 0.4))
+early_exit_chunk_trees = int(os.getenv('early_exit_chunk_trees', 250))
+early_exit_min_trees = int(os.getenv('early_exit_min_trees', 500))
+early_exit_z = float(os.getenv('early_exit_z', 3))
+tree_engine_max_rows = int(os.getenv('tree_engine_max_rows', 64))
 
 
-def data_prep(df, trained_features):
+def data_prep(df, encoder):
     logger.info('Preparing data for prediction')
-    required_columns = ['perfumer', 'brand_name', 'notes', 'accords', 'perfume_id']
-    if not all(col in df.columns for col in required_columns):
-        raise ValueError(f"Input DataFrame must contain the following columns: {required_columns}")
-    df['desc'] = (df['perfumer'] + ',' + df['brand_name'] + ',' + df['notes'] + ',' + df['accords']) \
-        .str.lower().str.replace('[()-]', ' ', regex=True).str.split(',')
-    perfume_info = df[['perfume_id', 'desc']].explode('desc')
-    perfume_info = pd.get_dummies(perfume_info, columns=['desc'], prefix='', prefix_sep='')
-    perfume_info = perfume_info.groupby('perfume_id', as_index=False).sum()
-    perfume_info = perfume_info.loc[:, (perfume_info != 0).any(axis=0)]
-    missing_features = list(set(trained_features) - set(perfume_info.columns))
-    if missing_features:
-        missing_df = pd.DataFrame(0, index=perfume_info.index, columns=missing_features)
-        perfume_info = pd.concat([perfume_info, missing_df], axis=1)
-    perfume_info = perfume_info[trained_features]
-    logger.info('Data for prediction is ready')
-    return perfume_info
-
-
-def get_prediction(new_data):
+    new_prep, perfume_ids = encoder.transform(df)
+    logger.info(f'Data for prediction is ready: {new_prep.shape[0]} perfumes, {new_prep.nnz} features set')
+    return new_prep, perfume_ids
+
+
+def positive_proba(model, new_prep):
+    proba = model.predict_proba(new_prep)
+    classes = list(model.classes_)
+    if 1 not in classes:
+        return np.zeros(new_prep.shape[0]), proba
+    return proba[:, classes.index(1)], proba
+
+
+def prediction_label(probability):
+    return np.where(probability > like_threshold, 1.0, np.where(probability < dislike_threshold, 0.0, 0.5))
+
+
+def fit_calibration(probability, y):
+    # Platt scaling of the ensemble output, fitted on the held-out split
+    if len(np.unique(y)) < 2:
+        return None
+    logit = np.log(np.clip(probability, 1e-6, 1 - 1e-6) / (1 - np.clip(probability, 1e-6, 1 - 1e-6)))
+    calibrator = LogisticRegression(C=1e6).fit(logit.reshape(-1, 1), y)
+    return {'method': 'platt', 'a': float(calibrator.coef_[0][0]), 'b': float(calibrator.intercept_[0]),
+            'rows': int(len(y))}
+
+
+def calibrate(probability, calibration):
+    if not calibration:
+        return probability
+    clipped = np.clip(probability, 1e-6, 1 - 1e-6)
+    return 1 / (1 + np.exp(-(calibration['a'] * np.log(clipped / (1 - clipped)) + calibration['b'])))
+
+
+def sklearn_forest(forest):
+    classes = list(forest.classes_)
+
+    def tree_votes(rows, start, stop):
+        trees = forest.estimators_[start:stop]
+        if 1 not in classes:
+            return np.zeros((rows.shape[0], len(trees)))
+        return np.column_stack([tree.predict_proba(rows, check_input=False)[:, classes.index(1)] for tree in trees])
+
+    return len(forest.estimators_), tree_votes, lambda new_prep: positive_proba(forest, new_prep)[0]
+
+
+def forest_positive_proba(forest, new_prep, decisive=None, chunk_trees=early_exit_chunk_trees,
+                          min_trees=early_exit_min_trees, z=early_exit_z):
+    n_trees, tree_votes, full_proba = forest
+    if decisive is None or n_trees <= min_trees:
+        return full_proba(new_prep), np.full(new_prep.shape[0], n_trees)
+    new_prep = sparse.csr_matrix(new_prep, dtype=np.float32)
+    total = np.zeros(new_prep.shape[0])
+    squares = np.zeros(new_prep.shape[0])
+    evaluated = np.zeros(new_prep.shape[0], dtype=int)
+    active = np.arange(new_prep.shape[0])
+    for start in range(0, n_trees, chunk_trees):
+        votes = tree_votes(new_prep[active], start, start + chunk_trees)
+        total[active] += votes.sum(axis=1)
+        squares[active] += (votes ** 2).sum(axis=1)
+        evaluated[active] += votes.shape[1]
+        if evaluated[active[0]] < min_trees or evaluated[active[0]] == n_trees:
+            continue
+        # Rows stop once the forest mean is far enough from every message boundary for the remaining trees not to matter
+        mean = total[active] / evaluated[active]
+        error = z * np.sqrt(np.maximum(squares[active] / evaluated[active] - mean ** 2, 0) / evaluated[active])
+        active = active[~decisive(active, mean - error, mean + error)]
+        if not active.size:
+            break
+    return total / evaluated, evaluated
+
+
+def use_engine(models, rows):
+    return models.get('engine') is not None and (rows <= tree_engine_max_rows or 'rf_model' not in models)
+
+
+def ensemble_proba(models, new_prep, weights=None, early_exit=False):
+    weights = weights or model_weights
+    weight_sum = weights['rf_model'] + weights['xgb_model']
+    rf_weight = weights['rf_model'] / weight_sum
+    xgb_weight = weights['xgb_model'] / weight_sum
+    if use_engine(models, new_prep.shape[0]):
+        engine = models['engine']
+        forest = engine.n_rf_trees, engine.rf_votes, engine.rf_positive_proba
+        xgb_probability = engine.xgb_positive_proba(new_prep)
+    else:
+        forest = sklearn_forest(models['rf_model'])
+        xgb_probability, _ = positive_proba(models['xgb_model'], new_prep)
+    calibration = models.get('calibration')
+
+    def decisive(rows, rf_low, rf_high):
+        low = calibrate(rf_weight * np.clip(rf_low, 0, 1) + xgb_weight * xgb_probability[rows], calibration)
+        high = calibrate(rf_weight * np.clip(rf_high, 0, 1) + xgb_weight * xgb_probability[rows], calibration)
+        return prediction_label(low) == prediction_label(high)
+
+    rf_probability, trees = forest_positive_proba(forest, new_prep, decisive if early_exit else None)
+    probability = calibrate(rf_weight * rf_probability + xgb_weight * xgb_probability, calibration)
+    return probability, trees
+
+
+def scoring_models(rows):
+    # The compiled trees answer small requests, the pickled models are only loaded for large batches
+    models = model_registry.get()
+    if use_engine(models, rows):
+        return models
+    return model_registry.get(with_models=True)
+
+
+@timed(prediction_seconds, 'function')
+def get_prediction(new_data, early_exit=True):
     logger.info('Getting prediction')
-    client = MongoClient(m_string)
-    db = client['scent_db']
-    collection = db['training_features']
-    retrieved_document = collection.find_one({'list_name': 'scent_train'})
-    trained_features = retrieved_document['list_data'] if retrieved_document else None
-
-    def get_model(model_name,db):
-        fs = gridfs.GridFS(db)
-        file_data = fs.find_one({'filename': f'{model_name}.pkl'})
-        model_bytes = io.BytesIO(file_data.read())
-        return joblib.load(model_bytes)
-
-    new_prep = data_prep(new_data, trained_features)
-    rf_model = get_model('rf_model',db)
-    xgb_model = get_model('xgb_model',db)
-    rf_prediction = rf_model.predict(new_prep)
-    xgb_prediction = xgb_model.predict(new_prep)
-    avg_prediction = (rf_prediction + xgb_prediction) / 2
-    logger.info(f'Prediction: {avg_prediction[0]}')
-    client.close()
-    return avg_prediction[0]
+    models = scoring_models(new_data.perfume_id.nunique())
+    new_prep, _ = data_prep(new_data, models['encoder'])
+    probability, trees = ensemble_proba(models, new_prep, early_exit=early_exit)
+    logger.info(f'Prediction: {probability[0]:.3f} after {trees[0]} RF trees (models version {models["version"]})')
+    return probability[0]
+
+
+@timed(prediction_seconds, 'function')
+def get_predictions(new_data, early_exit=False):
+    logger.info(f'Getting predictions for {new_data.perfume_id.nunique()} perfumes')
+    models = scoring_models(new_data.perfume_id.nunique())
+    new_prep, perfume_ids = data_prep(new_data, models['encoder'])
+    result = pd.DataFrame({'perfume_id': perfume_ids.astype(int)})
+    probability, trees = ensemble_proba(models, new_prep, early_exit=early_exit)
+    result['prediction'] = prediction_label(probability)
+    result['probability'] = probability
+    if 'full_name' in new_data.columns:
+        full_names = new_data.drop_duplicates('perfume_id').set_index('perfume_id')['full_name']
+        result.insert(1, 'full_name', result['perfume_id'].map(full_names))
+    result['version'] = models['version']
+    logger.info(f'{len(result)} predictions are ready after {trees.mean():.0f} RF trees on average '
+                f'(models version {models["version"]})')
+    return result
+
+
+def prediction_message(probability):
+    if probability < dislike_threshold:
+        return f'You will barely like it... ({probability:.0%} chance you like it)'
+    elif probability > like_threshold:
+        return f'Likely, you would find it quite nice ({probability:.0%} chance you like it)'
+    else:
+        return "Can't tell. I need more data"
@@ -0,0 +1,158 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from db import bulk_insert
+from parsers import perfume_data_parser, main_url
+
+
+logger = logging.getLogger(__name__)
+
+
+ingest_workers = int(os.getenv('ingest_workers', 4))
+ingest_per_host_concurrency = int(os.getenv('ingest_per_host_concurrency', 2))
+ingest_requests_per_second = float(os.getenv('ingest_requests_per_second', 1))
+ingest_max_retries = int(os.getenv('ingest_max_retries', 3))
+ingest_backoff_seconds = float(os.getenv('ingest_backoff_seconds', 2))
+ingest_write_batch_size = int(os.getenv('ingest_write_batch_size', 20))
+
+
+class HostLimiter:
+    def __init__(self, concurrency=ingest_per_host_concurrency, requests_per_second=ingest_requests_per_second):
+        self.concurrency = concurrency
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_start = defaultdict(float)
+
+    @contextmanager
+    def slot(self, host):
+        with self._lock:
+            semaphore = self._semaphores.setdefault(host, threading.BoundedSemaphore(self.concurrency))
+        with semaphore:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start[host])
+                self._next_start[host] = start + self.interval
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+
+def perfume_rows(perfume_id, data):
+    perfumer, accords, notes, rating, votes_number, reviews_data = data
+    return {
+        'perfumes_data': [[perfume_id,perfumer,accords,notes,rating,votes_number]],
+        'reviewers': [(el[0],el[1]) for el in reviews_data],
+        'reviews_data': [(f'{perfume_id}_{el[0]}',perfume_id,el[0],el[2],el[3]) for el in reviews_data],
+    }
+
+
+class BatchWriter:
+    def __init__(self, batch_size=ingest_write_batch_size, max_retries=ingest_max_retries,
+                 backoff_seconds=ingest_backoff_seconds):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.written = []
+        self.failed = []
+        self._pending = []
+
+    def add(self, perfume_id, data):
+        self._pending.append((perfume_id, data))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _write(self, pending):
+        batches = defaultdict(list)
+        for perfume_id, data in pending:
+            for table_name, rows in perfume_rows(perfume_id, data).items():
+                batches[table_name].extend(rows)
+        bulk_insert(batches)
+        self.written.extend(perfume_id for perfume_id, _ in pending)
+
+    def _write_one(self, perfume_id, data):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._write([(perfume_id, data)])
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f'Writing perfume {perfume_id} failed: {e}')
+                    self.failed.append(perfume_id)
+                    return
+                delay = self.backoff_seconds * 2 ** attempt * (1 + random.random())
+                logger.info(f'Writing perfume {perfume_id} failed, retry {attempt + 1}/{self.max_retries} '
+                            f'in {delay:.1f}s: {e}')
+                time.sleep(delay)
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        try:
+            self._write(pending)
+            logger.info(f'{len(pending)} perfumes written to perfumes_data, reviewers and reviews_data')
+        except Exception as e:
+            # The batch is one transaction, so one bad row rolls back the others, which are written one by one
+            logger.error(f'Writing {len(pending)} perfumes failed, writing them one by one: {e}')
+            for perfume_id, data in pending:
+                self._write_one(perfume_id, data)
+
+
+def fetch_perfume(perfume_url, limiter, max_retries=ingest_max_retries, backoff_seconds=ingest_backoff_seconds):
+    host = urlparse(f'{main_url}{perfume_url}').netloc
+    for attempt in range(max_retries + 1):
+        with limiter.slot(host):
+            try:
+                data = perfume_data_parser(perfume_url)
+            except Exception as e:
+                logger.error(f'{perfume_url} parsing raised {e}')
+                data = 'fail'
+        if isinstance(data, list):
+            return data
+        if attempt < max_retries:
+            delay = backoff_seconds * 2 ** attempt * (1 + random.random())
+            logger.info(f'{perfume_url} parsing failed, retry {attempt + 1}/{max_retries} in {delay:.1f}s')
+            time.sleep(delay)
+    return None
+
+
+def split_row(row):
+    try:
+        perfume_id, perfume_url = row
+    except (TypeError, ValueError):
+        perfume_id = row[0]
+        perfume_url = row[-2]
+    return perfume_id, perfume_url
+
+
+def ingest_perfumes(new_perfumes, workers=ingest_workers, limiter=None, writer=None):
+    new_perfumes = [split_row(row) for row in new_perfumes]
+    limiter = limiter or HostLimiter()
+    writer = writer or BatchWriter()
+    parse_failed = []
+    started = time.perf_counter()
+    logger.info(f'Ingesting {len(new_perfumes)} perfumes with {workers} workers')
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest') as executor:
+        futures = {executor.submit(fetch_perfume, perfume_url, limiter): (perfume_id, perfume_url)
+                   for perfume_id, perfume_url in new_perfumes}
+        for future in as_completed(futures):
+            perfume_id, perfume_url = futures[future]
+            data = future.result()
+            if data is None:
+                logger.error(f'Can not parse {perfume_url}')
+                parse_failed.append(perfume_id)
+            else:
+                writer.add(perfume_id, data)
+    writer.flush()
+    summary = {'written': writer.written, 'parse_failed': parse_failed, 'write_failed': writer.failed}
+    logger.info(f'Ingest finished in {time.perf_counter() - started:.1f}s: {len(writer.written)} written, '
+                f'{len(parse_failed)} parse failures, {len(writer.failed)} write failures')
+    return summary
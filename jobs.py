@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from catalog import catalog_service
+from db import get_pred_df, get_pred_df_by_id, get_perfume_url, get_perfume_url_by_id
+from get_prediction import prediction_message
+from main import update_data
+from recommendations import predict_and_store
+
+
+logger = logging.getLogger(__name__)
+
+
+check_job_workers = int(os.getenv('check_job_workers', 2))
+check_job_ttl_seconds = float(os.getenv('check_job_ttl_seconds', 600))
+
+
+def fetch_and_score(perfume_name):
+    perfume_id = catalog_service.get_perfume_id(perfume_name)
+    if perfume_id is not None:
+        update_data([get_perfume_url_by_id(perfume_id)])
+        perfumes_data = get_pred_df_by_id(perfume_id)
+    else:
+        update_data([get_perfume_url(perfume_name)])
+        perfumes_data = get_pred_df(perfume_name)
+    if perfumes_data.empty:
+        raise ValueError(f"Can't get data for {perfume_name}")
+    predictions = predict_and_store(perfumes_data)
+    return prediction_message(predictions['probability'].iloc[0])
+
+
+class CheckJobQueue:
+    def __init__(self, run=fetch_and_score, workers=check_job_workers, ttl_seconds=check_job_ttl_seconds):
+        self.run = run
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='check-job')
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._in_flight = {}
+
+    def _expire(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished_at'] is not None and now - job['finished_at'] >= self.ttl_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, perfume_name):
+        with self._lock:
+            self._expire()
+            job_id = self._in_flight.get(perfume_name)
+            if job_id is not None:
+                logger.info(f'Check of {perfume_name} joined job {job_id}')
+                return dict(self._jobs[job_id])
+            job_id = uuid.uuid4().hex
+            job = {'id': job_id, 'perfume_name': perfume_name, 'status': 'pending', 'message': None,
+                   'created_at': time.time(), 'finished_at': None}
+            self._jobs[job_id] = job
+            self._in_flight[perfume_name] = job_id
+        logger.info(f'Check of {perfume_name} queued as job {job_id}')
+        self._executor.submit(self._execute, job_id)
+        return dict(job)
+
+    def _execute(self, job_id):
+        with self._lock:
+            job = self._jobs[job_id]
+            job['status'] = 'running'
+        try:
+            message = self.run(job['perfume_name'])
+            result = {'status': 'done', 'message': message}
+        except Exception as e:
+            logger.exception(f'Check job {job_id} for {job["perfume_name"]} failed: {e}')
+            result = {'status': 'failed', 'message': f"Can't get data for {job['perfume_name']}. Please try again in a few minutes"}
+        with self._lock:
+            job.update(result, finished_at=time.time())
+            self._in_flight.pop(job['perfume_name'], None)
+        logger.info(f'Check job {job_id} finished with status {result["status"]}')
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+
+check_jobs = CheckJobQueue()
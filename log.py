@@ -1,56 +1,182 @@
+import json
 import logging
 import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler
 
-from pymongo import MongoClient, errors
+from pymongo import errors
 
+from mongo import get_client, mongo_db_name
 
-m_string = os.getenv('m_string')
 
-class MongoDBHandler(logging.Handler):
-    def __init__(self, mongo_uri, db_name, collection_name):
-        super().__init__()
-        self.client = None
-        self.db = None
-        self.collection = None
-        try:
-            self.client = MongoClient(mongo_uri, serverSelectionTimeoutMS=1000)  # 5 seconds timeout
-            self.client.server_info()
-            self.db = self.client[db_name]
-            self.collection = self.db[collection_name]
-        except errors.ServerSelectionTimeoutError as err:
-            logging.error(f"Failed to connect to MongoDB: {err}")
-            if self.client is not None:
-                self.client.close()
-            self.client = None
-            self.db = None
-            self.collection = None
+log_to_mongo = os.getenv('log_to_mongo', '').lower() in ('1', 'true', 'yes')
+mongo_log_collection = os.getenv('mongo_log_collection', 'scent_recommender_logs')
+mongo_log_batch_size = int(os.getenv('mongo_log_batch_size', 100))
+mongo_log_flush_seconds = float(os.getenv('mongo_log_flush_seconds', 2))
+mongo_log_queue_size = int(os.getenv('mongo_log_queue_size', 10000))
+mongo_log_retry_seconds = float(os.getenv('mongo_log_retry_seconds', 30))
+mongo_log_spill_path = os.getenv('mongo_log_spill_path',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mongo_logs.spill.jsonl'))
+
+_STOP = object()
+
+
+class MongoDBHandler(QueueHandler):
+    def __init__(self, db_name, collection_name, batch_size=mongo_log_batch_size,
+                 flush_seconds=mongo_log_flush_seconds, queue_size=mongo_log_queue_size,
+                 retry_seconds=mongo_log_retry_seconds, spill_path=mongo_log_spill_path):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.retry_seconds = retry_seconds
+        self.spill_path = spill_path
+        self._writer = None
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._retry_at = 0.0
+        self._closed = False
+        self._stats = {'written': 0, 'spilled': 0, 'dropped': 0, 'failed_flushes': 0}
+
+    def _ensure_writer(self):
+        # The writer thread does not survive a fork, so each worker process starts its own
+        if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+            with self._writer_lock:
+                if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+                    self._writer = threading.Thread(target=self._run, name='mongo-log-writer', daemon=True)
+                    self._writer_pid = os.getpid()
+                    self._writer.start()
+
+    def prepare(self, record):
+        return {
+            'log': self.format(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'created': datetime.fromtimestamp(record.created, timezone.utc),
+            'process': record.process,
+            'thread': record.threadName,
+        }
 
     def emit(self, record):
-        if self.collection is not None:
-            log_entry = self.format(record)
-            self.collection.insert_one({'log': log_entry})
+        # Records raised while writing logs would feed back into the queue forever
+        if self._closed or threading.current_thread() is self._writer or record.name.startswith('pymongo'):
+            return
+        super().emit(record)
+
+    def enqueue(self, document):
+        self._ensure_writer()
+        try:
+            self.queue.put_nowait(document)
+        except queue.Full:
+            # Requests never wait for MongoDB, a full queue goes to the spill file instead
+            self._spill([document])
 
-    def close(self):
-        if self.client is not None:
-            self.client.close()
+    def _spill(self, documents):
+        with self._spill_lock:
+            if not self.spill_path:
+                self._stats['dropped'] += len(documents)
+                return
+            try:
+                with open(self.spill_path, 'a', encoding='utf-8') as file:
+                    for document in documents:
+                        document.pop('_id', None)
+                        file.write(json.dumps(document, default=str) + '\n')
+                self._stats['spilled'] += len(documents)
+            except OSError:
+                self._stats['dropped'] += len(documents)
+
+    def _write(self, documents):
+        if not documents:
+            return
+        if time.monotonic() < self._retry_at:
+            self._spill(documents)
+            return
+        try:
+            get_client()[self.db_name][self.collection_name].insert_many(documents, ordered=False)
+            self._stats['written'] += len(documents)
+        except errors.PyMongoError:
+            # An unreachable server would block the writer for the whole selection timeout on every batch
+            self._stats['failed_flushes'] += 1
+            self._retry_at = time.monotonic() + self.retry_seconds
+            self._spill(documents)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_seconds
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                self._write(batch)
+                return
+            if isinstance(item, threading.Event):
+                self._write(batch)
+                batch = []
+                item.set()
+                continue
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._write(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_seconds
+
+    def flush(self, timeout=10):
+        writer = self._writer
+        if writer is None or not writer.is_alive() or self._writer_pid != os.getpid():
+            return
+        flushed = threading.Event()
+        try:
+            self.queue.put(flushed, timeout=timeout)
+        except queue.Full:
+            return
+        flushed.wait(timeout)
+
+    def close(self, timeout=10):
+        # logging.shutdown closes every handler at exit, so buffered records are written before the process ends
+        if not self._closed:
+            self._closed = True
+            writer = self._writer
+            if writer is not None and writer.is_alive() and self._writer_pid == os.getpid():
+                try:
+                    self.queue.put(_STOP, timeout=timeout)
+                    writer.join(timeout)
+                except queue.Full:
+                    pass
+            leftover = []
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, dict):
+                    leftover.append(item)
+            self._write(leftover)
         super().close()
 
+    def get_stats(self):
+        return dict(self._stats, queued=self.queue.qsize())
+
 
 def setup_logging():
-    # mongo_uri = m_string
-    # db_name = 'scent_db'
-    # collection_name = 'scent_recommender_logs'
     logger = logging.getLogger()
     if not logger.hasHandlers():
         logger.setLevel(logging.INFO)
 
-        # mongo_handler = MongoDBHandler(mongo_uri, db_name, collection_name)
-        # mongo_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-        # logger.addHandler(mongo_handler)
+        if log_to_mongo:
+            mongo_handler = MongoDBHandler(mongo_db_name, mongo_log_collection)
+            mongo_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+            logger.addHandler(mongo_handler)
 
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
         logger.addHandler(console_handler)
 
     logger.info("Logging setup complete")
-
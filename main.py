@@ -1,6 +1,8 @@
 import logging
-from db import insert_data
-from parsers import get_brands_by_perfume, get_brand_catalog, perfume_data_parser
+from catalog_sync import brand_id, sync_brands
+from db import get_catalog_perfume_ids
+from ingest import ingest_perfumes
+from parsers import get_brands_by_perfume, hit_brand, hit_perfume_id, search_perfumes
 
 
 logger = logging.getLogger(__name__)
@@ -8,48 +10,26 @@ logger = logging.getLogger(__name__)
 
 def update_data(new_perfumes):
     logger.info('Updating perfumes_data, reviews_data, reviewers')
-    temp = []
-    for row in new_perfumes:
-        try:
-            perfume_id, perfume_url = row
-        except:
-            perfume_id = row[0]
-            perfume_url = row[-2]
-        data = perfume_data_parser(perfume_url)
-        if data != 'fail':
-            perfumer, accords, notes, rating, votes_number, reviews_data = data
-            insert_list = [[perfume_id,perfumer,accords,notes,rating,votes_number]]
-            insert_data('perfumes_data', insert_list)
-            logger.info(f'{perfume_url} added to perfumes_data')
-            if reviews_data:
-                insert_list = [(f'{perfume_id}_{el[0]}',perfume_id,el[0],el[2],el[3]) for el in reviews_data]
-                insert_data('reviews_data', insert_list)
-                logger.info(f'{perfume_url} added to reviews_data')
-                insert_list = [(el[0],el[1]) for el in reviews_data]
-                insert_data('reviewers', insert_list)
-                logger.info(f'{perfume_url} added to reviewers')
-            else:
-                logger.info(f'No reviews in {perfume_url}')
-        else:
-            logger.error(f'Can not parse "{row[1]},{row[2]}" reviews')
-            break
-    if temp and temp != 'fail':
+    summary = ingest_perfumes(new_perfumes)
+    if summary['written']:
         logger.info('Dataset has been updated')
+    return summary
 
 
 def query_catalog_parser(perfume_name):
     logger.info('Adding new data to catalog')
-    new_brands_data = get_brands_by_perfume(perfume_name)
-    if new_brands_data:
-        flag = True
-        for brand_data in new_brands_data:
-            insert_list = get_brand_catalog(brand_data)
-            if insert_list != 'fail':
-                insert_data('perfumes_catalog', insert_list)
-                logger.info(f'{brand_data[0][-1]} has been added to catalog')
-            else:
-                flag = False
-                break
-        return flag
-    else:
+    hits = search_perfumes(perfume_name)
+    if not hits:
         return 'empty'
+    summary = sync_brands(get_brands_by_perfume(hits))
+    if summary['failed']:
+        return False
+    # Brands synced within the TTL are skipped, so a perfume released since then is only found by a forced sync
+    brand_data, perfume_id = hit_brand(hits[0]), hit_perfume_id(hits[0])
+    if perfume_id in get_catalog_perfume_ids([brand_id(brand_data)]):
+        return True
+    logger.info(f'{perfume_name} is not in the catalog yet, syncing {brand_data[0]} again')
+    summary = sync_brands([brand_data], force=True)
+    if summary['failed']:
+        return False
+    return True if perfume_id in get_catalog_perfume_ids([brand_id(brand_data)]) else 'empty'
@@ -0,0 +1,191 @@
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, math.inf)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {", ".join(self.labelnames)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = {key: self._copy(value) for key, value in self._values.items()}
+        for key, value in sorted(values.items()):
+            lines.extend(self._samples(list(zip(self.labelnames, key)), value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _copy(self, value):
+        return value
+
+    def _samples(self, labels, value):
+        return [f'{self.name}_total{_format_labels(labels)} {_format_value(value)}']
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(set(buckets) | {math.inf}))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            # Buckets are stored non-cumulative and summed up on render
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def _copy(self, value):
+        return {'counts': list(value['counts']), 'sum': value['sum'], 'count': value['count']}
+
+    def _samples(self, labels, value):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value['counts']):
+            cumulative += count
+            samples.append(f'{self.name}_bucket{_format_labels(labels + [("le", _format_value(bound))])} {cumulative}')
+        samples.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(value["sum"])}')
+        samples.append(f'{self.name}_count{_format_labels(labels)} {value["count"]}')
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f'{name} is already registered as a {metric.kind}')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics_registry = MetricsRegistry()
+
+http_request_seconds = metrics_registry.histogram(
+    'scent_http_request_duration_seconds', 'Flask request duration', ['endpoint', 'method', 'status'])
+db_query_seconds = metrics_registry.histogram(
+    'scent_db_query_duration_seconds', 'Database query duration', ['query'])
+db_rows_written = metrics_registry.counter(
+    'scent_db_rows_written', 'Rows written by bulk_insert', ['table'])
+model_load_seconds = metrics_registry.histogram(
+    'scent_model_load_duration_seconds', 'GridFS model download and unpickling duration', ['model'])
+prediction_seconds = metrics_registry.histogram(
+    'scent_prediction_duration_seconds', 'Model scoring duration', ['function'])
+scrape_request_seconds = metrics_registry.histogram(
+    'scent_scrape_request_duration_seconds', 'Scrape request duration', ['kind', 'status'])
+page_cache_lookups = metrics_registry.counter(
+    'scent_page_cache_lookups', 'Page cache lookups by result', ['result'])
+training_stage_seconds = metrics_registry.histogram(
+    'scent_training_stage_duration_seconds', 'Training stage duration', ['stage'])
+
+
+@contextmanager
+def timer(histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+def timed(histogram, name_label=None, **labels):
+    def decorator(func):
+        if name_label:
+            labels[name_label] = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(histogram, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_app(app):
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            # The route pattern rather than the path, so every perfume name does not get its own series
+            endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method,
+                                         status=response.status_code)
+        return response
+
+    return app
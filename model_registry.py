@@ -0,0 +1,213 @@
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import gridfs
+import joblib
+from features import FeatureEncoder, check_model_features
+from metrics import model_load_seconds, timer
+from mongo import get_db
+from tree_engine import engine_path, load_engine, remove_old_engines
+
+
+logger = logging.getLogger(__name__)
+
+
+model_check_interval = float(os.getenv('model_check_interval', 30))
+
+MODEL_NAMES = ['rf_model', 'xgb_model']
+ENGINE_FILENAME = 'tree_engine.bin'
+
+
+class ModelRegistry:
+    def __init__(self, check_interval=model_check_interval, model_names=MODEL_NAMES):
+        self.check_interval = check_interval
+        self.model_names = list(model_names)
+        self._bundle = None
+        self._last_check = 0.0
+        self._rejection_listeners = []
+        self._rejected_version = None
+        self._load_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'reloads': 0, 'version_checks': 0, 'gridfs_downloads': 0}
+
+    def _db(self):
+        return get_db()
+
+    def add_rejection_listener(self, listener):
+        self._rejection_listeners.append(listener)
+
+    def _reject(self, version, reason):
+        # Serving can not recover from incompatible models by itself, so a full retrain is requested once per version
+        if version != self._rejected_version:
+            self._rejected_version = version
+            logger.error(f'Models version {version} are rejected: {reason}')
+            for listener in self._rejection_listeners:
+                try:
+                    listener(version, reason)
+                except Exception as e:
+                    logger.error(f'Rejection listener failed: {e}')
+        raise ValueError(reason)
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self._stats[name] += value
+
+    def get_published_version(self):
+        self._count('version_checks')
+        db = self._db()
+        document = db['training_features'].find_one({'list_name': 'scent_train'}, {'version': 1})
+        return self._document_version(db, document)
+
+    def _document_version(self, db, document):
+        if document and document.get('version'):
+            return str(document['version'])
+        # Models published before versioning was introduced only carry GridFS upload dates
+        files = db['fs.files'].find(
+            {'filename': {'$in': [f'{name}.pkl' for name in self.model_names]}}, {'uploadDate': 1})
+        upload_dates = [file['uploadDate'] for file in files]
+        return max(upload_dates).isoformat() if upload_dates else None
+
+    def _download(self):
+        started = time.perf_counter()
+        db = self._db()
+        # Features, calibration and version come from one read, so they always belong to the same publication
+        document = db['training_features'].find_one({'list_name': 'scent_train'})
+        if document is None or document.get('list_data') is None:
+            raise ValueError('Training features are not published')
+        version = self._document_version(db, document)
+        logger.info(f'Loading models version {version} from GridFS')
+        bundle = {
+            'version': version,
+            'versioned': bool(document.get('version')),
+            'trained_features': document['list_data'],
+            'loaded_at': time.time(),
+        }
+        if not document.get('encoder'):
+            self._reject(version, 'Published models predate the sparse feature encoder, a full retrain is needed')
+        bundle['calibration'] = document.get('calibration')
+        bundle['encoder'] = FeatureEncoder.from_features(bundle['trained_features'])
+        try:
+            bundle['engine'] = self._load_engine(db, version, bundle['encoder'])
+        except Exception as e:
+            logger.error(f'Compiled trees of version {version} can not be loaded: {e}')
+            bundle['engine'] = None
+        if bundle['engine'] is None:
+            self._load_models(db, bundle)
+        model_load_seconds.observe(time.perf_counter() - started, model='all')
+        logger.info(f'Models version {version} loaded in {time.perf_counter() - started:.2f}s')
+        return bundle
+
+    def _load_engine(self, db, version, encoder):
+        path = engine_path(version)
+        if not os.path.exists(path):
+            file_data = gridfs.GridFS(db).find_one({'filename': ENGINE_FILENAME, 'metadata.version': version})
+            if file_data is None:
+                return None
+            with timer(model_load_seconds, model='tree_engine'):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as file:
+                        for chunk in file_data:
+                            file.write(chunk)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+            self._count('gridfs_downloads')
+        engine = load_engine(path)
+        remove_old_engines(version)
+        if engine.meta['n_features'] != len(encoder):
+            raise ValueError(f'Compiled trees expect {engine.meta["n_features"]} features but the published encoder '
+                             f'has {len(encoder)}')
+        return engine
+
+    def _load_models(self, db, bundle):
+        fs = gridfs.GridFS(db)
+        for model_name in self.model_names:
+            # Versioned publications tag every file, older ones are matched by name only
+            query = {'filename': f'{model_name}.pkl'}
+            if bundle.get('versioned'):
+                query['metadata.version'] = bundle['version']
+            with timer(model_load_seconds, model=model_name):
+                file_data = fs.find_one(query)
+                if file_data is None:
+                    raise ValueError(f'{model_name} version {bundle["version"]} is not published')
+                model = joblib.load(io.BytesIO(file_data.read()))
+            try:
+                check_model_features(model_name, model, bundle['encoder'], bundle['trained_features'])
+            except ValueError as e:
+                self._reject(bundle['version'], str(e))
+            bundle[model_name] = model
+            self._count('gridfs_downloads')
+
+    def _is_due_for_check(self):
+        return time.monotonic() - self._last_check >= self.check_interval
+
+    def get(self, with_models=False):
+        bundle = self._get()
+        if not with_models or all(name in bundle for name in self.model_names):
+            return bundle
+        with self._load_lock:
+            if all(name in bundle for name in self.model_names):
+                return bundle
+            try:
+                self._load_models(self._db(), bundle)
+                return bundle
+            except ValueError as e:
+                logger.info(f'{e}, checking for a newer version')
+                self._last_check = 0.0
+        # A newer version was published after this bundle was loaded, its pickles replace the old ones in GridFS
+        bundle = self._get()
+        with self._load_lock:
+            if not all(name in bundle for name in self.model_names):
+                self._load_models(self._db(), bundle)
+        return bundle
+
+    def _get(self):
+        bundle = self._bundle
+        if bundle is not None and not self._is_due_for_check():
+            self._count('hits')
+            return bundle
+
+        with self._load_lock:
+            bundle = self._bundle
+            if bundle is not None and not self._is_due_for_check():
+                self._count('hits')
+                return bundle
+            try:
+                version = self.get_published_version()
+            except Exception as e:
+                if bundle is None:
+                    raise
+                logger.error(f'Model version check failed, serving version {bundle["version"]}: {e}')
+                self._last_check = time.monotonic()
+                self._count('hits')
+                return bundle
+            self._last_check = time.monotonic()
+            if bundle is not None and bundle['version'] == version:
+                self._count('hits')
+                return bundle
+
+            new_bundle = self._download()
+            self._count('misses' if bundle is None else 'reloads')
+            self._bundle = new_bundle
+            return new_bundle
+
+    def notify_published(self):
+        self._last_check = 0.0
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        bundle = self._bundle
+        stats['version'] = bundle['version'] if bundle else None
+        stats['loaded_at'] = bundle['loaded_at'] if bundle else None
+        return stats
+
+
+model_registry = ModelRegistry()
@@ -1,114 +1,376 @@
+import copy
 import logging
 import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import pandas as pd
 import numpy as np
-from sklearn.model_selection import train_test_split, GridSearchCV, KFold
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.model_selection import train_test_split, GridSearchCV, HalvingGridSearchCV, KFold
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, brier_score_loss, roc_auc_score
 from xgboost import XGBClassifier
 import joblib
-from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 import gridfs
 import io
+from datetime import datetime, timedelta, timezone
 from db import get_dataset_df
+from features import FeatureEncoder
+from get_prediction import calibrate, fit_calibration, model_weights, positive_proba
+from metrics import training_stage_seconds
+from model_registry import ENGINE_FILENAME, model_registry
+from mongo import get_db
+from recommendations import refresh_predictions
+from snapshot import build_snapshot, update_snapshot
+from tree_engine import export_engine
 
 
 logger = logging.getLogger(__name__)
 
 
-m_string = os.getenv('m_string')
+rf_trees = int(os.getenv('rf_trees', 10000))
+xgb_rounds = int(os.getenv('xgb_rounds', 10000))
+incremental_rf_trees = int(os.getenv('incremental_rf_trees', 500))
+incremental_xgb_rounds = int(os.getenv('incremental_xgb_rounds', 500))
+max_rf_trees = int(os.getenv('max_rf_trees', rf_trees + 4 * incremental_rf_trees))
+max_xgb_rounds = int(os.getenv('max_xgb_rounds', xgb_rounds + 4 * incremental_xgb_rounds))
+retrain_growth_fraction = float(os.getenv('retrain_growth_fraction', 0.2))
+full_search_interval_hours = float(os.getenv('full_search_interval_hours', 24 * 7))
+publish_lock_seconds = float(os.getenv('publish_lock_seconds', 600))
+training_source = os.getenv('training_source', 'snapshot')
+search_strategy = os.getenv('search_strategy', 'halving')
+search_cores = int(os.getenv('search_cores', os.cpu_count() or 1))
+search_folds = int(os.getenv('search_folds', 5))
+search_factor = int(os.getenv('search_factor', 3))
+search_min_trees = int(os.getenv('search_min_trees', 20))
+search_max_trees = int(os.getenv('search_max_trees', 180))
+search_scoring = os.getenv('search_scoring', 'accuracy')
+search_memmap_dir = os.getenv('search_memmap_dir') or None
 
+rf_param_grid = {
+    'max_depth': [10, 20, 30, 35, 50],
+    'max_features': ['sqrt', 'log2', 0.05],
+    'min_samples_leaf': [1, 2, 4],
+}
+xgb_param_grid = {
+    'max_depth': [3, 6, 10, 20, 30],
+    'learning_rate': [0.05, 0.1, 0.3],
+    'subsample': [0.8, 1.0],
+    'colsample_bytree': [0.5, 1.0],
+}
 
-def data_prep(df):
+
+@contextmanager
+def log_duration(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        training_stage_seconds.observe(duration, stage=stage)
+        logger.info(f'{stage} took {duration:.2f}s')
+
+
+def data_prep(df, encoder=None):
     logger.info('Preparing data for model training')
-    df['desc'] = (df['perfumer'] + ',' + df['brand_name'] + ',' + df['notes'] + ',' + df[
-        'accords']).str.lower().str.replace('[()-]', ' ', regex=True).str.split(',')
-    perfume_info = df[['perfume_id', 'desc', 'vote']]
-    perfume_info = perfume_info.explode('desc')
-    perfume_info = pd.get_dummies(perfume_info, columns=['desc'], prefix='')
-    perfume_info = perfume_info.groupby(['perfume_id', 'vote'], as_index=False).sum()
-    perfume_info = perfume_info.drop(['_'], axis=1)
-    return perfume_info
+    if encoder is None:
+        encoder = FeatureEncoder().fit(df)
+    X, perfume_ids = encoder.transform(df)
+    y = df.drop_duplicates('perfume_id').set_index('perfume_id').loc[perfume_ids, 'vote'].astype(int).to_numpy()
+    logger.info(f'Training data is ready: {X.shape[0]} perfumes, {X.shape[1]} features')
+    return X, y, encoder
+
+
+@contextmanager
+def shared_training_data(X, y):
+    # Search workers map the dumped arrays instead of receiving a pickled copy of the matrix with every fold
+    folder = tempfile.mkdtemp(prefix='scent-search-', dir=search_memmap_dir)
+    try:
+        path = os.path.join(folder, 'training.joblib')
+        joblib.dump((X, y), path)
+        yield joblib.load(path, mmap_mode='r')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
 
 
-def RandomForest_result(final_df):
+def search_params(name, estimator, param_grid, X_train, y_train, n_jobs=search_cores):
+    cv = KFold(n_splits=search_folds, shuffle=True, random_state=42)
+    if search_strategy == 'grid':
+        estimator.set_params(n_estimators=search_max_trees)
+        search = GridSearchCV(estimator, param_grid, cv=cv, scoring=search_scoring, n_jobs=n_jobs, refit=False,
+                              error_score='raise')
+    else:
+        # Every candidate starts with a few trees, only the best third moves on to three times as many
+        search = HalvingGridSearchCV(estimator, param_grid, factor=search_factor, resource='n_estimators',
+                                     min_resources=search_min_trees, max_resources=search_max_trees, cv=cv,
+                                     scoring=search_scoring, n_jobs=n_jobs, refit=False, random_state=42,
+                                     error_score='raise')
+    with log_duration(f'{name} {search_strategy} search'):
+        search.fit(X_train, y_train)
+    best_params = {param: value for param, value in search.best_params_.items() if param != 'n_estimators'}
+    logger.info(f'Best {name} parameters: {best_params}')
+    logger.info(f'Best {name} {search_scoring}: {search.best_score_:.4f} '
+                f'({len(search.cv_results_["params"])} candidate evaluations of {search_folds} folds)')
+    return best_params
+
+
+def tune_models(X, y):
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+    with log_duration('Hyperparameter search'), shared_training_data(X_train, y_train) as (X_shared, y_shared):
+        # Both searches submit to one pool of search_cores workers, so neither waits for the other to finish
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='search') as executor:
+            rf_search = executor.submit(search_params, 'RF', RandomForestClassifier(), rf_param_grid,
+                                        X_shared, y_shared)
+            xgb_search = executor.submit(search_params, 'XGB', XGBClassifier(n_jobs=1), xgb_param_grid,
+                                         X_shared, y_shared)
+            return rf_search.result(), xgb_search.result()
+
+
+def RandomForest_result(X, y, best_params=None):
     logger.info('RF model training started')
-    X = final_df.drop(['perfume_id','vote'], axis=1)
-    y = final_df[['vote']]
-    y = np.squeeze(y)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
-    rf_model = RandomForestClassifier(n_estimators=100)
-    cv = KFold(n_splits=10, shuffle=True, random_state=42)
-    param_grids = {
-        'max_depth': [10,20,30,35]
-    }
-    grids = GridSearchCV(estimator=rf_model, param_grid=param_grids, cv=cv, scoring='accuracy', n_jobs=-1, verbose=2, error_score='raise')
-    grids.fit(X_train, y_train)
-    best_params = grids.best_params_
-    best_score = grids.best_score_
-    logger.info(f'Best RandomForest parameters: {best_params}')
-    logger.info(f'Best RandomForest score: {best_score}')
-    rf_model = RandomForestClassifier(n_estimators=10000, max_depth=best_params['max_depth'])
-    rf_model.fit(X_train, y_train)
+    if best_params is None:
+        with shared_training_data(X_train, y_train) as (X_shared, y_shared):
+            best_params = search_params('RF', RandomForestClassifier(), rf_param_grid, X_shared, y_shared)
+    rf_model = RandomForestClassifier(n_estimators=rf_trees, **best_params)
+    with log_duration('RF fit'), joblib.parallel_config(n_jobs=search_cores):
+        rf_model.fit(X_train, y_train)
     logger.info('RF model trained')
+    return rf_model, best_params
+
+
+def RandomForest_update(rf_model, X, y):
+    logger.info('RF warm start training started')
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+    # The published forest is shared with the model registry, so new trees are grown on a copy
+    rf_model = copy.deepcopy(rf_model)
+    rf_model.set_params(warm_start=True, n_estimators=rf_model.n_estimators + incremental_rf_trees)
+    with log_duration('RF warm start fit'), joblib.parallel_config(n_jobs=search_cores):
+        rf_model.fit(X_train, y_train)
+    rf_model.set_params(warm_start=False)
+    logger.info(f'RF model updated to {rf_model.n_estimators} trees')
     return rf_model
 
 
-def XGB_result(final_df):
+def XGB_result(X, y, best_params=None):
     logger.info('XGB model training started')
-    X = final_df.drop(['perfume_id', 'vote'], axis=1)
-    y = final_df[['vote']]
-    y = np.squeeze(y)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
-    xgb_model = XGBClassifier(n_estimators=100)
-    cv = KFold(n_splits=10, shuffle=True, random_state=42)
-    param_grids = {
-        'max_depth': [10, 20, 30, 35]
-    }
-    grids = GridSearchCV(estimator=xgb_model, param_grid=param_grids, cv=cv, scoring='accuracy', n_jobs=-1, verbose=2,
-                         error_score='raise')
-    grids.fit(X_train, y_train)
-    best_params = grids.best_params_
-    best_score = grids.best_score_
-    logger.info(f'Best XGB parameters: {best_params}')
-    logger.info(f'Best XGB score: {best_score}')
-    xgb_model = XGBClassifier(n_estimators=10000, max_depth=best_params['max_depth'])
-    xgb_model.fit(X_train, y_train)
+    if best_params is None:
+        with shared_training_data(X_train, y_train) as (X_shared, y_shared):
+            best_params = search_params('XGB', XGBClassifier(n_jobs=1), xgb_param_grid, X_shared, y_shared)
+    xgb_model = XGBClassifier(n_estimators=xgb_rounds, **best_params)
+    with log_duration('XGB fit'):
+        xgb_model.fit(X_train, y_train)
     logger.info('XGB model trained')
-    return xgb_model
-
-
-def train_model():
-    df = get_dataset_df()
-    df_prep = data_prep(df)
-    features = df_prep.drop(['perfume_id','vote'], axis=1).columns.tolist()
-    rf_model = RandomForest_result(df_prep)
-    xgb_model = XGB_result(df_prep)
-    client = MongoClient(m_string)
-    db = client['scent_db']
-    collection = db['training_features']
-    list_document = {'list_name': 'scent_train', 'list_data': features}
-    collection.update_one(
-        {'list_name': 'scent_train'},
-        {'$set': list_document},
-        upsert=True
-    )
-    logger.info(f'Training features have been saved')
-
-    def load_model(model_name, client):
-        logger.info(f'{model_name} loading')
-        model_bytes = io.BytesIO()
-        joblib.dump(model_dict[model_name], model_bytes)
-        model_bytes.seek(0)
-        db = client['scent_db']
-        fs = gridfs.GridFS(db)
-        existing_file = fs.find_one({'filename': f'{model_name}.pkl'})
-        if existing_file:
-            fs.delete(existing_file._id)
-        fs.put(model_bytes, filename=f'{model_name}.pkl')
-        logger.info(f'{model_name} saved')
-
-    model_dict = {'rf_model': rf_model, 'xgb_model': xgb_model}
-    for model in model_dict.keys():
-        load_model(model, client)
-    client.close()
+    return xgb_model, best_params
+
+
+def XGB_update(xgb_model, X, y, best_params):
+    logger.info('XGB continuation training started')
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+    new_model = XGBClassifier(n_estimators=incremental_xgb_rounds, **best_params)
+    with log_duration('XGB continuation fit'):
+        new_model.fit(X_train, y_train, xgb_model=xgb_model.get_booster())
+    logger.info(f'XGB model updated to {new_model.get_booster().num_boosted_rounds()} rounds')
+    return new_model
+
+
+def _scores(y_test, probability):
+    scores = {'accuracy': float(accuracy_score(y_test, probability > 0.5)),
+              'brier': float(brier_score_loss(y_test, probability))}
+    if len(np.unique(y_test)) > 1:
+        scores['roc_auc'] = float(roc_auc_score(y_test, probability))
+    return scores
+
+
+def evaluate_models(rf_model, xgb_model, X, y):
+    # The same split as in training, so the held-out rows were not seen by freshly fitted models
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+    rf_probability, _ = positive_proba(rf_model, X_test)
+    xgb_probability, _ = positive_proba(xgb_model, X_test)
+    weight_sum = model_weights['rf_model'] + model_weights['xgb_model']
+    probability = (model_weights['rf_model'] * rf_probability
+                   + model_weights['xgb_model'] * xgb_probability) / weight_sum
+    scores = {'rows': int(len(y_test)), 'rf': _scores(y_test, rf_probability), 'xgb': _scores(y_test, xgb_probability),
+              'ensemble': _scores(y_test, probability)}
+    logger.info(f'Held-out scores on {len(y_test)} perfumes: ' + ', '.join(
+        f'{name} ' + ' '.join(f'{metric} {value:.4f}' for metric, value in scores[name].items())
+        for name in ('rf', 'xgb', 'ensemble')))
+    calibration = fit_calibration(probability, y_test)
+    if calibration is None:
+        logger.info('Held-out split has a single class, probabilities are not calibrated')
+        return None, scores
+    scores['calibrated'] = _scores(y_test, calibrate(probability, calibration))
+    logger.info(f'Held-out Brier score: {scores["ensemble"]["brier"]:.4f} raw, '
+                f'{scores["calibrated"]["brier"]:.4f} calibrated')
+    return calibration, scores
+
+
+@contextmanager
+def publish_lock(db, timeout=publish_lock_seconds):
+    # Lease document shared by every app process, so two jobs never write the published models at once
+    owner = f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+    deadline = time.monotonic() + timeout
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            db['training_locks'].update_one(
+                {'_id': 'scent_train_publish', 'expires_at': {'$lt': now}},
+                {'$set': {'owner': owner, 'expires_at': now + timedelta(seconds=timeout)}},
+                upsert=True
+            )
+            break
+        except DuplicateKeyError:
+            if time.monotonic() >= deadline:
+                raise TimeoutError('Models are being published by another job')
+            time.sleep(1)
+    logger.info(f'Publish lock acquired by {owner}')
+    try:
+        yield
+    finally:
+        db['training_locks'].delete_one({'_id': 'scent_train_publish', 'owner': owner})
+
+
+def get_training_state(db):
+    return db['training_state'].find_one({'name': 'scent_train'}) or {}
+
+
+def choose_training_mode(mode, state, rows, models):
+    if mode == 'full':
+        return 'full', 'requested'
+    if not state.get('rf_params') or not state.get('xgb_params'):
+        return 'full', 'no tuned hyperparameters'
+    if models is None:
+        return 'full', 'no published sparse models to continue from'
+    # Every incremental run only appends, so the models are refitted from scratch before they outgrow the limits
+    rf_size = models['rf_model'].n_estimators + incremental_rf_trees
+    xgb_size = models['xgb_model'].get_booster().num_boosted_rounds() + incremental_xgb_rounds
+    if rf_size > max_rf_trees or xgb_size > max_xgb_rounds:
+        return 'full', (f'models would grow to {rf_size} RF trees and {xgb_size} XGB rounds, '
+                        f'over the {max_rf_trees}/{max_xgb_rounds} limit')
+    if mode == 'incremental':
+        return 'incremental', 'requested'
+    if rows >= state['tuned_rows'] * (1 + retrain_growth_fraction):
+        return 'full', f'dataset grew from {state["tuned_rows"]} to {rows} rows'
+    if datetime.now(timezone.utc) - state['tuned_at'].replace(tzinfo=timezone.utc) >= timedelta(hours=full_search_interval_hours):
+        return 'full', f'last search is older than {full_search_interval_hours} hours'
+    return 'incremental', f'dataset grew from {state["tuned_rows"]} to {rows} rows'
+
+
+def train_model(mode='auto'):
+    started = time.perf_counter()
+    db = get_db()
+    dataset = None
+    df = None
+    if training_source == 'snapshot':
+        try:
+            with log_duration('Dataset snapshot update'):
+                dataset = update_snapshot()
+            rows = dataset.rows
+        except Exception as e:
+            logger.error(f'Dataset snapshot is not available, reading the database instead: {e}')
+            dataset = None
+    if dataset is None:
+        with log_duration('Dataset loading'):
+            df = get_dataset_df()
+        rows = int(df['perfume_id'].nunique())
+    state = get_training_state(db)
+    models = None
+    if mode != 'full' and state:
+        try:
+            models = model_registry.get(with_models=True)
+        except Exception as e:
+            logger.error(f'Published models are not available for incremental training: {e}')
+    training_mode, reason = choose_training_mode(mode, state, rows, models)
+    logger.info(f'{training_mode.capitalize()} training started: {reason}')
+
+    if training_mode == 'full':
+        if dataset is not None:
+            if dataset.rows != dataset.manifest['built_rows'] or dataset.manifest.get('reencoded_rows'):
+                # Appended and edited rows were encoded with the old vocabulary, so the search gets a freshly fitted one
+                with log_duration('Dataset snapshot rebuild'):
+                    dataset = build_snapshot()
+            X, y, encoder = dataset.X, dataset.votes.astype(int), dataset.encoder()
+        else:
+            with log_duration('Data preparation'):
+                X, y, encoder = data_prep(df)
+        rf_params, xgb_params = tune_models(X, y)
+        rf_model, _ = RandomForest_result(X, y, rf_params)
+        xgb_model, _ = XGB_result(X, y, xgb_params)
+        with log_duration('Held-out evaluation'):
+            calibration, holdout_scores = evaluate_models(rf_model, xgb_model, X, y)
+        state_update = {'rf_params': rf_params, 'xgb_params': xgb_params, 'holdout_scores': holdout_scores,
+                        'tuned_rows': rows, 'tuned_at': datetime.now(timezone.utc)}
+    else:
+        # The published vocabulary is kept so the new trees share the feature space of the existing ones
+        encoder = models['encoder']
+        if dataset is not None and dataset.vocabulary == encoder.features:
+            X, y = dataset.X, dataset.votes.astype(int)
+        else:
+            with log_duration('Data preparation'):
+                X, y, encoder = data_prep(df if df is not None else get_dataset_df(), encoder)
+        rf_model = RandomForest_update(models['rf_model'], X, y)
+        xgb_model = XGB_update(models['xgb_model'], X, y, state['xgb_params'])
+        # The kept trees were fitted on a split of a smaller dataset, so most rows of a new split are not held out
+        calibration = models['calibration']
+        logger.info('Calibration and held-out scores of the last full training are kept')
+        state_update = {}
+
+    version = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')
+    # A folder of this run only: the registry prunes old versions from tree_engine_dir while training runs
+    engine_dir = tempfile.mkdtemp(prefix='scent-engine-')
+    try:
+        try:
+            with log_duration('Trees compilation'):
+                engine_file = export_engine(rf_model, xgb_model, X, version, engine_dir)
+        except Exception as e:
+            # Serving falls back to the pickled models when a version has no compiled trees
+            logger.error(f'Trees compilation failed, publishing without compiled trees: {e}')
+            engine_file = None
+
+        with publish_lock(db):
+            fs = gridfs.GridFS(db)
+
+            def load_model(model_name, model):
+                logger.info(f'{model_name} loading')
+                model_bytes = io.BytesIO()
+                joblib.dump(model, model_bytes)
+                model_bytes.seek(0)
+                fs.put(model_bytes, filename=f'{model_name}.pkl', metadata={'version': version})
+                logger.info(f'{model_name} saved')
+
+            with log_duration('Models publishing'):
+                if engine_file:
+                    with open(engine_file, 'rb') as file:
+                        fs.put(file, filename=ENGINE_FILENAME, metadata={'version': version})
+                    logger.info('Compiled trees saved')
+                for model_name, model in {'rf_model': rf_model, 'xgb_model': xgb_model}.items():
+                    load_model(model_name, model)
+            # Features, calibration and version change in one write, once every file of the version is uploaded
+            list_document = {'list_name': 'scent_train', 'list_data': encoder.features, 'encoder': 'sparse_vocabulary',
+                             'calibration': calibration, 'version': version}
+            db['training_features'].update_one({'list_name': 'scent_train'}, {'$set': list_document}, upsert=True)
+            logger.info(f'Models version {version} published')
+            for filename in [ENGINE_FILENAME, 'rf_model.pkl', 'xgb_model.pkl']:
+                for existing_file in fs.find({'filename': filename, 'metadata.version': {'$ne': version}}):
+                    fs.delete(existing_file._id)
+            state_update.update({'rows': rows, 'mode': training_mode, 'version': version,
+                                 'trained_at': datetime.now(timezone.utc)})
+            db['training_state'].update_one({'name': 'scent_train'}, {'$set': state_update}, upsert=True)
+    finally:
+        shutil.rmtree(engine_dir, ignore_errors=True)
+    model_registry.notify_published()
+    try:
+        with log_duration('Predictions refresh'):
+            refresh_predictions()
+    except Exception as e:
+        logger.error(f'Predictions refresh failed: {e}')
+    duration = time.perf_counter() - started
+    training_stage_seconds.observe(duration, stage=f'{training_mode.capitalize()} training')
+    logger.info(f'{training_mode.capitalize()} training finished in {duration:.2f}s')
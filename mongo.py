@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+
+from pymongo import MongoClient
+
+
+logger = logging.getLogger(__name__)
+
+
+m_string = os.getenv('m_string')
+mongo_db_name = os.getenv('mongo_db_name', 'scent_db')
+mongo_max_pool_size = int(os.getenv('mongo_max_pool_size', 20))
+mongo_min_pool_size = int(os.getenv('mongo_min_pool_size', 0))
+mongo_server_selection_timeout_ms = int(os.getenv('mongo_server_selection_timeout_ms', 5000))
+mongo_connect_timeout_ms = int(os.getenv('mongo_connect_timeout_ms', 5000))
+mongo_socket_timeout_ms = int(os.getenv('mongo_socket_timeout_ms', 60000))
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_fraga_key = None
+
+
+def get_client():
+    global _client, _client_pid
+    # MongoClient is not fork-safe, so each worker process gets its own pool
+    if _client is None or _client_pid != os.getpid():
+        with _lock:
+            if _client is None or _client_pid != os.getpid():
+                logger.info('Creating MongoDB client')
+                _client = MongoClient(
+                    m_string,
+                    maxPoolSize=mongo_max_pool_size,
+                    minPoolSize=mongo_min_pool_size,
+                    serverSelectionTimeoutMS=mongo_server_selection_timeout_ms,
+                    connectTimeoutMS=mongo_connect_timeout_ms,
+                    socketTimeoutMS=mongo_socket_timeout_ms,
+                )
+                _client_pid = os.getpid()
+    return _client
+
+
+def get_db(db_name=mongo_db_name):
+    return get_client()[db_name]
+
+
+def close_client():
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def get_fraga_key():
+    global _fraga_key
+    if _fraga_key is None:
+        document = get_db()['keys'].find_one({'fraga_key': {'$exists': True}})
+        if document:
+            _fraga_key = document['fraga_key']
+    return _fraga_key
+
+
+def reset_fraga_key():
+    global _fraga_key
+    _fraga_key = None
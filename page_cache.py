@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+from metrics import page_cache_lookups
+
+
+logger = logging.getLogger(__name__)
+
+
+page_cache_dir = os.getenv('page_cache_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.page_cache'))
+page_cache_ttl_seconds = float(os.getenv('page_cache_ttl_seconds', 24 * 60 * 60))
+page_cache_offline = os.getenv('page_cache_offline', '').lower() in ('1', 'true', 'yes')
+
+
+class PageCache:
+    def __init__(self, directory=page_cache_dir, ttl_seconds=page_cache_ttl_seconds, offline=page_cache_offline):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.offline = offline
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        folder = os.path.join(self.directory, key[:2])
+        return os.path.join(folder, f'{key}.json'), os.path.join(folder, f'{key}.html.z')
+
+    def _write_atomic(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            with open(body_path, 'rb') as file:
+                body = zlib.decompress(file.read())
+        except (OSError, ValueError, zlib.error):
+            return None, None
+        return meta, body
+
+    def put(self, url, body, headers=None):
+        headers = headers or {}
+        meta_path, body_path = self._paths(url)
+        meta = {
+            'url': url,
+            'fetched_at': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        # The body goes first, so a metadata file always points to a complete page
+        self._write_atomic(body_path, zlib.compress(body, 6))
+        self._write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def touch(self, url, meta):
+        meta = dict(meta, fetched_at=time.time())
+        self._write_atomic(self._paths(url)[0], json.dumps(meta).encode('utf-8'))
+
+    def is_fresh(self, meta, max_age=None):
+        max_age = self.ttl_seconds if max_age is None else max_age
+        return self.offline or time.time() - meta['fetched_at'] < max_age
+
+    def fetch(self, url, fetch, max_age=None):
+        meta, body = self.get(url)
+        if meta is not None and self.is_fresh(meta, max_age):
+            page_cache_lookups.inc(result='hit')
+            logger.info(f'{url} served from page cache')
+            return body
+
+        conditional_headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                conditional_headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                conditional_headers['If-Modified-Since'] = meta['last_modified']
+        response = fetch(conditional_headers)
+        if response is None:
+            page_cache_lookups.inc(result='error')
+            return None
+        if response.status_code == 304 and meta is not None:
+            page_cache_lookups.inc(result='revalidated')
+            logger.info(f'{url} not modified, page cache revalidated')
+            self.touch(url, meta)
+            return body
+        if response.status_code == 200:
+            page_cache_lookups.inc(result='miss')
+            self.put(url, response.content, response.headers)
+            return response.content
+        page_cache_lookups.inc(result='error')
+        return None
+
+
+page_cache = PageCache()
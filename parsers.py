@@ -1,30 +1,45 @@
 import logging
-import itertools
 import os
+import threading
 
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup as bs
-from fake_useragent import UserAgent
 import json
-from pymongo import MongoClient
+import time
 import cloudscraper
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+from metrics import scrape_request_seconds
+from mongo import get_fraga_key, reset_fraga_key
+from page_cache import page_cache
+from proxies import ProxyPool, get_user_agent
 
 
 logger = logging.getLogger(__name__)
 
 
 proxy_url = os.getenv('proxy_url')
-m_string = os.getenv('m_string')
 main_url = os.getenv('main_url')
 
+_scrapers = threading.local()
+
+
+def get_scraper():
+    # cloudscraper sessions keep solved challenges and connections, so each thread reuses its own
+    scraper = getattr(_scrapers, 'scraper', None)
+    if scraper is None:
+        scraper = cloudscraper.create_scraper()
+        _scrapers.scraper = scraper
+    return scraper
+
 
 def get_proxies(url=proxy_url):
     logger.info('get_proxies has started')
     session = requests.Session()
-    user_agent = UserAgent()
-    random_user_agent = user_agent.random
-    headers = {'User-Agent': random_user_agent}
+    headers = {'User-Agent': get_user_agent()}
 
     try:
         with session.get(url, headers=headers, timeout=5) as response:
@@ -40,6 +55,9 @@ def get_proxies(url=proxy_url):
         session.close()
 
 
+proxy_pool = ProxyPool(source=get_proxies, session=get_scraper)
+
+
 def get_page_elements(soup):
     logger.info('Getting page elements')
     if soup.find_all('span', string='Perfumer') or soup.find_all('span', string='Perfumers'):
@@ -72,43 +90,101 @@ def get_page_elements(soup):
     return perfume_page_data
 
 
+def _class_xpath(class_name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+if etree is not None:
+    lxml_parser = etree.HTMLParser()
+    xpath_perfumers_box = etree.XPath(
+        "(//span[.='Perfumer']|//span[.='Perfumers'])[1]/parent::*/following-sibling::*[1]")
+    xpath_noses = etree.XPath(".//a[contains(@href, '/noses/')]")
+    xpath_accords = etree.XPath("//div[normalize-space(@class)='cell accord-box']")
+    xpath_notes = etree.XPath("//a[contains(@href, $notes_url)]")
+    xpath_rating_spans = etree.XPath(f"(//p[{_class_xpath('info-note')}])[1]//span")
+    xpath_reviews = etree.XPath("//div[@itemprop='review']")
+    xpath_review_member = etree.XPath(f"(.//b[{_class_xpath('idLinkify')}])[1]")
+    xpath_review_body = etree.XPath("(.//div[@itemprop='reviewBody'])[1]")
+
+
+def _text(el):
+    # BeautifulSoup collapses whitespace-only strings to a single '\n' or ' ', so the same is done here
+    return ''.join(text if text.strip() else '\n' if '\n' in text else ' ' for text in el.itertext())
+
+
+def get_page_elements_lxml(html):
+    logger.info('Getting page elements')
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    tree = etree.fromstring(html, lxml_parser)
+    perfumers_box = xpath_perfumers_box(tree)
+    if perfumers_box:
+        perfumer = [_text(el) for el in xpath_noses(perfumers_box[0])]
+        if len(perfumer) > 1:
+            perfumer = ','.join(perfumer)
+        else:
+            perfumer = perfumer[0]
+    else:
+        perfumer = 'unknown'
+    accords = ','.join([_text(el) for el in xpath_accords(tree)])
+    notes = ','.join([_text(el.getparent()) for el in xpath_notes(tree, notes_url=f'{main_url}/notes')])
+    rating_box = xpath_rating_spans(tree)
+    rating = float(_text(rating_box[0]))
+    votes_number = int(_text(rating_box[2]).replace(',',''))
+    reviews_info = []
+    for el in xpath_reviews(tree):
+        member_box = xpath_review_member(el)[0]
+        review_box = xpath_review_body(el)[0]
+        reviewer_id, reviewer, review = (member_box.get('title').split('/')[-1], _text(member_box), _text(review_box).replace('\n\n', ' '))
+        reviews_info.append((reviewer_id, reviewer, review, None))
+    perfume_page_data = [perfumer,accords,notes,rating,votes_number,reviews_info]
+    return perfume_page_data
+
+
+def parse_perfume_page(html):
+    if etree is not None:
+        return get_page_elements_lxml(html)
+    return get_page_elements(bs(html, 'html.parser'))
+
+
+def fetch_page(url, headers=None, timeout=None):
+    scraper = get_scraper()
+
+    def fetch(conditional_headers):
+        started = time.perf_counter()
+        try:
+            response = scraper.get(url, headers={**(headers or {}), **conditional_headers}, timeout=timeout)
+        except Exception:
+            scrape_request_seconds.observe(time.perf_counter() - started, kind='direct', status='error')
+            raise
+        scrape_request_seconds.observe(time.perf_counter() - started, kind='direct', status=response.status_code)
+        if response.status_code in (200, 304):
+            return response
+        logger.info(f'{url} parsing failed.{response}. Trying proxies')
+        started = time.perf_counter()
+        proxy_response = proxy_pool.fetch(url, scraper, timeout=timeout or 3)
+        scrape_request_seconds.observe(time.perf_counter() - started, kind='proxy',
+                                       status=proxy_response.status_code if proxy_response is not None else 'error')
+        return proxy_response or response
+
+    return page_cache.fetch(url, fetch)
+
+
 def perfume_data_parser(perfume_url):
     url = f'{main_url}{perfume_url}'
-    scraper = cloudscraper.create_scraper()
     try:
-        response = scraper.get(url)
-        if response.status_code == 200:
-            soup = bs(response.text, 'html.parser')
-            data = get_page_elements(soup)
+        html = fetch_page(url)
+        if html is not None:
+            data = parse_perfume_page(html)
             return data
-        else:
-            logger.info(f'{url} parsing failed.{response}. Getting proxies')
-            proxies_list = get_proxies()
-            proxies_cycle = itertools.cycle(proxies_list)
-            for i in range(len(proxies_list)):
-                proxy = next(proxies_cycle)
-                logger.info(f'Checking {proxy}')
-                proxies = {'http': proxy, 'https': proxy}
-                try:
-                    user_agent = UserAgent()
-                    random_user_agent = user_agent.random
-                    headers = {'User-Agent': random_user_agent}
-                    response = scraper.get(url, headers=headers, proxies=proxies,timeout=3)
-                    if response.status_code == 200:
-                        soup = bs(response.content, 'html.parser')
-                        data = get_page_elements(soup)
-                        return data
-                    else:
-                        logger.info(f'{perfume_url} parsing with {proxy} failed, response code: {response.status_code}')
-                        continue
-                except:
-                    continue
+        logger.error(f'{perfume_url} parsing failed with all proxies')
+        return 'fail'
     except:
         logger.error('Parsing failed with all options')
         return 'fail'
 
 
-def get_brands_by_perfume(perfume):
+def search_perfumes(perfume):
     logger.info('get_brand_url started')
     headers = {
         'sec-ch-ua': '"Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"',
@@ -119,51 +195,57 @@ def get_brands_by_perfume(perfume):
     }
 
     data = '{"requests":[{"indexName":"fragrantica_perfumes","params":"attributesToRetrieve=%5B%22naslov%22%2C%22dizajner%22%2C%22godina%22%2C%22url.EN%22%2C%22thumbnail%22%5D&facets=%5B%22designer_meta.category%22%2C%22designer_meta.country%22%2C%22designer_meta.main_activity%22%2C%22designer_meta.parent_company%22%2C%22dizajner%22%2C%22godina%22%2C%22ingredients.EN%22%2C%22nosevi%22%2C%22osobine.EN%22%2C%22rating_rounded%22%2C%22spol%22%5D&highlightPostTag=__%2Fais-highlight__&highlightPreTag=__ais-highlight__&hitsPerPage=80&maxValuesPerFacet=10&page=0&query=' + perfume + '&tagFilters="}]}'
-    client = MongoClient(m_string)
-    db = client['scent_db']
-    collection = db['keys']
-    query = {"fraga_key": {"$exists": True}}
-    document = collection.find_one(query)
-    if document:
-        url = document.get("fraga_key", "Key not found")
+    url = get_fraga_key()
+    if url:
         logger.info(f"Fraga key: {url}")
-        client.close()
+        started = time.perf_counter()
         response = requests.post(
                 url,
                 headers=headers,
                 data=data,
             )
+        scrape_request_seconds.observe(time.perf_counter() - started, kind='brand_search', status=response.status_code)
         if response.status_code == 200:
             data = json.loads(response.text)
-            options = data['results'][0]['hits']
-            brands_data = [[el['dizajner'],el['url']['EN'][0].split('/')[4], f"/designers/{el['url']['EN'][0].split('/')[4]}.html"] for el in options]
-            df = pd.DataFrame({'lists': brands_data})
-            df_unique = df.drop_duplicates(subset='lists')
-            brands_data = df_unique['lists'].tolist()
-            logger.info('Brands data parsed')
-            return brands_data[:3]
+            return data['results'][0]['hits']
         else:
             logger.error(f'Could not parse brands data. Response code: {response.status_code}')
+            if response.status_code in (401, 403):
+                reset_fraga_key()
             return []
     else:
         logger.error('Key not found')
 
 
+def hit_brand(hit):
+    brand = hit['url']['EN'][0].split('/')[4]
+    return [hit['dizajner'], brand, f"/designers/{brand}.html"]
+
+
+def hit_perfume_id(hit):
+    return int(hit['url']['EN'][0].split('-')[-1].split('.')[0])
+
+
+def get_brands_by_perfume(hits):
+    brands_data = [hit_brand(el) for el in hits]
+    df = pd.DataFrame({'lists': brands_data})
+    df_unique = df.drop_duplicates(subset='lists')
+    brands_data = df_unique['lists'].tolist()
+    logger.info('Brands data parsed')
+    return brands_data[:3]
+
+
 def get_brand_catalog(brand_data):
     logger.info(f'{brand_data[0]} catalog parsing started')
     url = f'{main_url}{brand_data[2]}'
-    scraper = cloudscraper.create_scraper()
-    user_agent = UserAgent()
-    random_user_agent = user_agent.random
-    headers = {'User-Agent': random_user_agent}
-    response = scraper.get(url, headers=headers, timeout=5)
-    if response.status_code == 200:
-        soup = bs(response.text, 'html.parser')
+    html = fetch_page(url, headers={'User-Agent': get_user_agent()}, timeout=5)
+    if html is not None:
+        soup = bs(html, 'html.parser')
         brand_id = brand_data[2].split('/')[2].replace('.html','')
         all_a = soup.find_all('a', href=lambda href: href and f"/perfume/{url.split('/')[-1].replace('.html','')}" in href)
         perfumes = [(el['href'].split('-')[-1].split('.')[0],'-'.join(el['href'].split('/')[-1].split('-')[:-1]),el.text.strip(),el['href'], brand_id) for el in all_a]
         logger.info(f'{brand_data[0]} library successfully parsed')
         return perfumes
     else:
-        logger.error(f'Library parser response code: {response.status_code}')
+        logger.error(f'{url} library parsing failed')
         return 'fail'
\ No newline at end of file
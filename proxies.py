@@ -0,0 +1,145 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from fake_useragent import UserAgent
+
+
+logger = logging.getLogger(__name__)
+
+
+proxy_list_ttl_seconds = float(os.getenv('proxy_list_ttl_seconds', 1800))
+proxy_probe_url = os.getenv('proxy_probe_url', os.getenv('main_url'))
+proxy_probe_timeout = float(os.getenv('proxy_probe_timeout', 3))
+proxy_probe_workers = int(os.getenv('proxy_probe_workers', 20))
+proxy_probe_limit = int(os.getenv('proxy_probe_limit', 100))
+proxy_fetch_attempts = int(os.getenv('proxy_fetch_attempts', 10))
+proxy_max_failures = int(os.getenv('proxy_max_failures', 3))
+
+_user_agent = None
+_user_agent_lock = threading.Lock()
+
+
+def get_user_agent():
+    global _user_agent
+    # UserAgent() loads its data file, so one instance is shared by every request
+    if _user_agent is None:
+        with _user_agent_lock:
+            if _user_agent is None:
+                _user_agent = UserAgent()
+    return _user_agent.random
+
+
+class ProxyPool:
+    def __init__(self, source, ttl_seconds=proxy_list_ttl_seconds, probe_url=proxy_probe_url,
+                 probe_timeout=proxy_probe_timeout, probe_workers=proxy_probe_workers,
+                 probe_limit=proxy_probe_limit, max_failures=proxy_max_failures, session=None):
+        self.source = source
+        self.session = session
+        self.ttl_seconds = ttl_seconds
+        self.probe_url = probe_url
+        self.probe_timeout = probe_timeout
+        self.probe_workers = probe_workers
+        self.probe_limit = probe_limit
+        self.max_failures = max_failures
+        self._lock = threading.RLock()
+        self._stats = {}
+        self._fetched_at = None
+
+    def _new_stats(self):
+        return {'successes': 0, 'failures': 0, 'consecutive_failures': 0, 'latency': None, 'probed': False}
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and self._fetched_at is not None and time.monotonic() - self._fetched_at < self.ttl_seconds:
+                return
+            proxies = self.source() or []
+            # Proxies that kept failing get a fresh probe once the list is downloaded again
+            self._stats = {proxy: self._stats[proxy]
+                           if proxy in self._stats and self._stats[proxy]['consecutive_failures'] < self.max_failures
+                           else self._new_stats() for proxy in proxies}
+            self._fetched_at = time.monotonic()
+            logger.info(f'Proxy pool refreshed: {len(self._stats)} proxies')
+
+    def record_success(self, proxy, latency):
+        with self._lock:
+            stats = self._stats.setdefault(proxy, self._new_stats())
+            stats['successes'] += 1
+            stats['consecutive_failures'] = 0
+            stats['latency'] = latency if stats['latency'] is None else 0.7 * stats['latency'] + 0.3 * latency
+
+    def record_failure(self, proxy):
+        with self._lock:
+            stats = self._stats.setdefault(proxy, self._new_stats())
+            stats['failures'] += 1
+            stats['consecutive_failures'] += 1
+
+    def _probe_one(self, proxy):
+        started = time.perf_counter()
+        try:
+            # Probes are sent the way pages are fetched, a bare client is refused by the site through any proxy
+            session = self.session() if self.session else requests
+            response = session.get(self.probe_url, proxies={'http': proxy, 'https': proxy},
+                                   headers={'User-Agent': get_user_agent()}, timeout=self.probe_timeout)
+            # A proxy answering with its own error page is reachable but can not fetch anything
+            if 200 <= response.status_code < 400:
+                self.record_success(proxy, time.perf_counter() - started)
+            else:
+                self.record_failure(proxy)
+        except requests.exceptions.RequestException:
+            self.record_failure(proxy)
+        finally:
+            with self._lock:
+                self._stats[proxy]['probed'] = True
+
+    def probe(self, proxies=None):
+        with self._lock:
+            if proxies is None:
+                proxies = [proxy for proxy, stats in self._stats.items() if not stats['probed']][:self.probe_limit]
+        if not proxies or not self.probe_url:
+            return
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.probe_workers, thread_name_prefix='proxy-probe') as executor:
+            list(executor.map(self._probe_one, proxies))
+        logger.info(f'Probed {len(proxies)} proxies in {time.perf_counter() - started:.1f}s, '
+                    f'{len(self._healthy())} healthy')
+
+    def _rank(self, item):
+        proxy, stats = item
+        latency = stats['latency'] if stats['latency'] is not None else float('inf')
+        return stats['consecutive_failures'], latency, -stats['successes']
+
+    def _healthy(self):
+        with self._lock:
+            return [item for item in self._stats.items()
+                    if item[1]['consecutive_failures'] < self.max_failures and item[1]['latency'] is not None]
+
+    def best(self, limit=proxy_fetch_attempts, probe=True):
+        self.refresh()
+        if probe and len(self._healthy()) < limit:
+            self.probe()
+        return [proxy for proxy, _ in sorted(self._healthy(), key=self._rank)[:limit]]
+
+    def fetch(self, url, session, timeout=3, attempts=proxy_fetch_attempts):
+        for proxy in self.best(attempts):
+            logger.info(f'Checking {proxy}')
+            started = time.perf_counter()
+            try:
+                response = session.get(url, headers={'User-Agent': get_user_agent()},
+                                       proxies={'http': proxy, 'https': proxy}, timeout=timeout)
+            except Exception:
+                self.record_failure(proxy)
+                continue
+            if response.status_code == 200:
+                self.record_success(proxy, time.perf_counter() - started)
+                return response
+            logger.info(f'{url} parsing with {proxy} failed, response code: {response.status_code}')
+            self.record_failure(proxy)
+        return None
+
+    def get_stats(self):
+        with self._lock:
+            return {proxy: dict(stats) for proxy, stats in self._stats.items()}
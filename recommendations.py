@@ -0,0 +1,59 @@
+import logging
+import os
+from datetime import datetime, timezone
+
+from db import insert_data, get_unvoted_pred_df, get_top_predictions, get_stored_prediction, get_stored_prediction_by_id
+from get_prediction import get_predictions
+from model_registry import model_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+predictions_chunk_size = int(os.getenv('predictions_chunk_size', 1000))
+
+
+def store_predictions(predictions):
+    updated_at = datetime.now(timezone.utc)
+    insert_list = [[int(row.perfume_id), float(row.prediction), float(row.probability), row.version, updated_at]
+                   for row in predictions.itertuples(index=False)]
+    if insert_list:
+        insert_data('predictions', insert_list)
+    return len(insert_list)
+
+
+def predict_and_store(perfumes_data, early_exit=False):
+    predictions = get_predictions(perfumes_data, early_exit=early_exit)
+    # Early-exit probabilities are only good for the label, ranking and the freshness check need full-forest scores
+    if not early_exit:
+        store_predictions(predictions)
+    return predictions
+
+
+def refresh_predictions(chunk_size=predictions_chunk_size):
+    logger.info('Refreshing predictions for unvoted perfumes')
+    perfumes_data = get_unvoted_pred_df()
+    perfume_ids = perfumes_data['perfume_id'].unique()
+    stored = 0
+    for start in range(0, len(perfume_ids), chunk_size):
+        chunk_ids = perfume_ids[start:start + chunk_size]
+        chunk = perfumes_data[perfumes_data['perfume_id'].isin(chunk_ids)].copy()
+        stored += store_predictions(get_predictions(chunk))
+    logger.info(f'{stored} predictions have been stored')
+    return stored
+
+
+def get_recommendations(limit=20, offset=0):
+    return get_top_predictions(limit=limit, offset=offset)
+
+
+def get_fresh_prediction(perfume_name, perfume_id=None):
+    if perfume_id is not None:
+        stored_prediction = get_stored_prediction_by_id(perfume_id)
+    else:
+        stored_prediction = get_stored_prediction(perfume_name)
+    if stored_prediction is None:
+        return None
+    if stored_prediction['model_version'] != model_registry.get()['version']:
+        return None
+    return stored_prediction
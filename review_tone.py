@@ -0,0 +1,171 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+
+from db import stream_unscored_reviews, update_review_tones
+from mongo import get_db
+
+
+logger = logging.getLogger(__name__)
+
+
+review_tone_chunk_size = int(os.getenv('review_tone_chunk_size', 5000))
+review_tone_workers = int(os.getenv('review_tone_workers', max(1, (os.cpu_count() or 2) - 1)))
+review_tone_margin = float(os.getenv('review_tone_margin', 0))
+
+POSITIVE_WORDS = {
+    'love': 2, 'loved': 2, 'loving': 1, 'beautiful': 2, 'gorgeous': 2, 'amazing': 2, 'lovely': 2, 'wonderful': 2,
+    'great': 1, 'nice': 1, 'pleasant': 1, 'elegant': 1, 'favorite': 2, 'favourite': 2, 'fantastic': 2, 'perfect': 2,
+    'delicious': 2, 'stunning': 2, 'compliments': 2, 'masterpiece': 3, 'divine': 2, 'addictive': 2, 'sexy': 1,
+    'cozy': 1, 'excellent': 2, 'best': 2, 'enjoy': 1, 'gem': 2, 'recommend': 2, 'unique': 1, 'sophisticated': 1,
+    'incredible': 2, 'awesome': 2, 'classy': 1, 'happy': 1, 'good': 1, 'heavenly': 2, 'dreamy': 1,
+    'smooth': 1, 'wearable': 1, 'obsessed': 2, 'beast': 1, 'impressive': 1, 'refreshing': 1,
+}
+NEGATIVE_WORDS = {
+    'hate': 3, 'hated': 3, 'awful': 3, 'terrible': 3, 'horrible': 3, 'disgusting': 3, 'cheap': 2, 'synthetic': 1,
+    'headache': 2, 'nauseating': 3, 'nausea': 2, 'sour': 1, 'weak': 1, 'boring': 2, 'disappointing': 2,
+    'disappointed': 2, 'disappointment': 2, 'worst': 3, 'bad': 2, 'scrubber': 3, 'unpleasant': 2, 'harsh': 1,
+    'overpriced': 2, 'generic': 1, 'fades': 1, 'vanishes': 1, 'poor': 2, 'meh': 1, 'sickening': 3, 'chemical': 1,
+    'pungent': 1, 'screechy': 2, 'cloying': 2, 'ugly': 2, 'regret': 2, 'waste': 2, 'sadly': 1, 'unfortunately': 1,
+    'unwearable': 3, 'returned': 1, 'rancid': 3, 'stale': 1,
+}
+NEGATORS = ['not', 'no', 'never', 'hardly', 'barely', 'dont', 'didnt', 'doesnt', 'isnt', 'wasnt', 'wouldnt', 'couldnt',
+            'cant', 'wont', 'aint', 'arent', 'werent']
+
+_vectorizer = None
+_weights = None
+
+
+def lexicon():
+    weights = {**{word: float(weight) for word, weight in POSITIVE_WORDS.items()},
+               **{word: -float(weight) for word, weight in NEGATIVE_WORDS.items()}}
+    # A negated word cancels its own unigram and counts with the opposite sign: "not good" is -1, not +1
+    for word, weight in list(weights.items()):
+        for negator in NEGATORS:
+            weights[f'{negator} {word}'] = -2 * weight
+    return weights
+
+
+def normalize(review):
+    # "don't" becomes "dont" rather than "don" and "t", so contractions match the negators
+    return review.lower().replace("'", '').replace('\u2019', '')
+
+
+def get_vectorizer():
+    global _vectorizer, _weights
+    if _vectorizer is None:
+        weights = lexicon()
+        _vectorizer = CountVectorizer(vocabulary=list(weights), ngram_range=(1, 2), preprocessor=normalize,
+                                      token_pattern=r'(?u)\b\w+\b')
+        _weights = np.array([weights[term] for term in _vectorizer.vocabulary], dtype=np.float32)
+    return _vectorizer, _weights
+
+
+def score_reviews(reviews, margin=review_tone_margin):
+    vectorizer, weights = get_vectorizer()
+    scores = vectorizer.transform([review or '' for review in reviews]) @ weights
+    return [True if score > margin else False if score < -margin else None for score in scores]
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class ReviewTonePipeline:
+    def __init__(self, workers=review_tone_workers, chunk_size=review_tone_chunk_size):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._worker = None
+        self._status = {'running': False, 'started_at': None, 'finished_at': None, 'error': None, 'scored': 0,
+                        'neutral': 0, 'watermark': None}
+
+    def start(self, reset=False):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self.run, kwargs={'reset': reset}, name='review-tone',
+                                                daemon=True)
+                self._worker.start()
+                logger.info('Review tone scoring started')
+        return self.get_status()
+
+    def get_status(self):
+        with self._lock:
+            return dict(self._status)
+
+    def _save(self, db, review_ids, tones):
+        update_review_tones(list(zip(review_ids, tones)))
+        scored = [tone for tone in tones if tone is not None]
+        # Scored reviews drop out of the query, the watermark only lets an interrupted run skip the finished chunks
+        db['pipeline_state'].update_one(
+            {'name': 'review_tone'},
+            {'$set': {'watermark': review_ids[-1], 'updated_at': datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        with self._lock:
+            self._status['scored'] += len(scored)
+            self._status['neutral'] += len(review_ids) - len(scored)
+            self._status['watermark'] = review_ids[-1]
+
+    def run(self, reset=False):
+        started = time.perf_counter()
+        with self._lock:
+            self._status.update(running=True, started_at=_now(), finished_at=None, error=None, scored=0, neutral=0)
+        try:
+            db = get_db()
+            state = db['pipeline_state'].find_one({'name': 'review_tone'}) or {}
+            watermark = None if reset else state.get('watermark')
+            logger.info(f'Scoring review tones after {watermark or "the first review"} on {self.workers} processes')
+            # Spawned workers do not inherit the app's threads, connections and locks
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as executor:
+                pending = deque()
+                for chunk in stream_unscored_reviews(watermark, self.chunk_size):
+                    review_ids = [review_id for review_id, _ in chunk]
+                    pending.append((review_ids, executor.submit(score_reviews, [review for _, review in chunk])))
+                    # Chunks are written in cursor order, so the watermark never passes an unwritten review
+                    while len(pending) > self.workers:
+                        review_ids, future = pending.popleft()
+                        self._save(db, review_ids, future.result())
+                while pending:
+                    review_ids, future = pending.popleft()
+                    self._save(db, review_ids, future.result())
+            # New reviews do not arrive in review_id order, so the next pass starts from the beginning again
+            db['pipeline_state'].update_one(
+                {'name': 'review_tone'},
+                {'$set': {'watermark': None, 'completed_at': datetime.now(timezone.utc)}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.exception(f'Review tone scoring failed: {e}')
+            with self._lock:
+                self._status['error'] = str(e)
+        finally:
+            with self._lock:
+                self._status.update(running=False, finished_at=_now())
+                status = dict(self._status)
+        logger.info(f'Review tone scoring finished in {time.perf_counter() - started:.1f}s: '
+                    f'{status["scored"]} scored, {status["neutral"]} neutral')
+        return status
+
+
+review_tone_pipeline = ReviewTonePipeline()
+
+
+if __name__ == '__main__':
+    import argparse
+    from log import setup_logging
+
+    argument_parser = argparse.ArgumentParser(description='Score the tone of unscored reviews')
+    argument_parser.add_argument('--reset', action='store_true', help='Start from the first review')
+    args = argument_parser.parse_args()
+    setup_logging()
+    review_tone_pipeline.run(reset=args.reset)
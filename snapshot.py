@@ -0,0 +1,179 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from db import get_dataset_df, get_dataset_votes_df
+from features import DESC_COLUMNS, FeatureEncoder
+
+
+logger = logging.getLogger(__name__)
+
+
+dataset_snapshot_dir = os.getenv('dataset_snapshot_dir',
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dataset_snapshot'))
+
+ARRAY_NAMES = ['perfume_ids', 'votes', 'row_hashes', 'data', 'indices', 'indptr']
+
+_snapshot_lock = threading.RLock()
+
+
+class DatasetSnapshot:
+    def __init__(self, manifest, arrays):
+        self.manifest = manifest
+        self.perfume_ids = arrays['perfume_ids']
+        self.votes = arrays['votes']
+        self.row_hashes = arrays['row_hashes']
+        self.X = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                   shape=(len(arrays['perfume_ids']), len(manifest['vocabulary'])), copy=False)
+
+    @property
+    def vocabulary(self):
+        return self.manifest['vocabulary']
+
+    @property
+    def rows(self):
+        return self.manifest['rows']
+
+    def encoder(self):
+        return FeatureEncoder(self.vocabulary)
+
+
+def content_hash(arrays, vocabulary):
+    digest = hashlib.sha256(json.dumps(vocabulary).encode('utf-8'))
+    for name in ARRAY_NAMES:
+        digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return digest.hexdigest()
+
+
+def row_hashes(df):
+    # Hash of the columns the encoder reads, so edited perfumes_data rows are noticed without re-encoding every row
+    return pd.util.hash_pandas_object(df[DESC_COLUMNS].fillna('').astype(str), index=False).to_numpy(dtype=np.uint64)
+
+
+def write_snapshot(arrays, vocabulary, built_rows, reencoded_rows=0, directory=dataset_snapshot_dir):
+    manifest = {
+        'vocabulary': vocabulary,
+        'rows': int(len(arrays['perfume_ids'])),
+        'nnz': int(len(arrays['data'])),
+        'max_perfume_id': int(arrays['perfume_ids'].max()) if len(arrays['perfume_ids']) else None,
+        'built_rows': int(built_rows),
+        'reencoded_rows': int(reencoded_rows),
+        'content_hash': content_hash(arrays, vocabulary),
+        'updated_at': datetime.now(timezone.utc).isoformat(),
+    }
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_directory = tempfile.mkdtemp(dir=parent, prefix='.snapshot-')
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(tmp_directory, f'{name}.npy'), arrays[name])
+    with open(os.path.join(tmp_directory, 'manifest.json'), 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    # Swap whole directories, so readers never mix arrays of two snapshot versions
+    old_directory = None
+    if os.path.exists(directory):
+        old_directory = tempfile.mkdtemp(dir=parent, prefix='.snapshot-old-')
+        os.rmdir(old_directory)
+        os.replace(directory, old_directory)
+    os.replace(tmp_directory, directory)
+    if old_directory:
+        shutil.rmtree(old_directory, ignore_errors=True)
+    logger.info(f'Dataset snapshot written: {manifest["rows"]} rows, {manifest["nnz"]} non-zeros, '
+                f'hash {manifest["content_hash"][:12]}')
+    return manifest
+
+
+def load_snapshot(directory=dataset_snapshot_dir, mmap_mode='r', verify=True):
+    manifest_path = os.path.join(directory, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        manifest = json.load(file)
+    try:
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode=mmap_mode) for name in ARRAY_NAMES}
+    except FileNotFoundError as e:
+        logger.warning(f'Dataset snapshot is incomplete or from an older version: {e}')
+        return None
+    if verify and content_hash(arrays, manifest['vocabulary']) != manifest.get('content_hash'):
+        logger.error('Dataset snapshot does not match its content hash')
+        return None
+    return DatasetSnapshot(manifest, arrays)
+
+
+def encode_rows(df, encoder):
+    X, perfume_ids = encoder.transform(df)
+    rows = df.drop_duplicates('perfume_id').set_index('perfume_id').loc[perfume_ids]
+    return X, np.asarray(perfume_ids, dtype=np.int64), rows['vote'].astype(np.int8).to_numpy(), row_hashes(rows)
+
+
+def build_snapshot(directory=dataset_snapshot_dir):
+    logger.info('Building dataset snapshot')
+    started = time.perf_counter()
+    with _snapshot_lock:
+        df = get_dataset_df()
+        encoder = FeatureEncoder().fit(df)
+        X, perfume_ids, votes, hashes = encode_rows(df, encoder)
+        arrays = {'perfume_ids': perfume_ids, 'votes': votes, 'row_hashes': hashes,
+                  'data': X.data, 'indices': X.indices, 'indptr': X.indptr}
+        write_snapshot(arrays, encoder.features, len(perfume_ids), directory=directory)
+    logger.info(f'Dataset snapshot built in {time.perf_counter() - started:.2f}s')
+    return load_snapshot(directory, verify=False)
+
+
+def update_snapshot(directory=dataset_snapshot_dir):
+    snapshot = load_snapshot(directory, mmap_mode=None)
+    if snapshot is None:
+        return build_snapshot(directory)
+    started = time.perf_counter()
+    with _snapshot_lock:
+        state_df = get_dataset_votes_df().drop_duplicates('perfume_id')
+        current_votes = dict(zip(state_df['perfume_id'].astype(int), state_df['vote'].astype(np.int8)))
+        current_hashes = dict(zip(state_df['perfume_id'].astype(int), row_hashes(state_df)))
+        position = {int(perfume_id): i for i, perfume_id in enumerate(snapshot.perfume_ids)}
+        if set(position) - set(current_votes):
+            # Rows can only disappear when catalog or votes were deleted, which appending cannot express
+            logger.info('Rows were removed from the dataset, rebuilding snapshot')
+            return build_snapshot(directory)
+
+        votes = snapshot.votes.copy()
+        changed = 0
+        for perfume_id, i in position.items():
+            if votes[i] != current_votes[perfume_id]:
+                votes[i] = current_votes[perfume_id]
+                changed += 1
+        new_ids = sorted(set(current_votes) - set(position))
+        edited_ids = sorted(perfume_id for perfume_id, i in position.items()
+                            if snapshot.row_hashes[i] != current_hashes[perfume_id])
+        X = snapshot.X
+        perfume_ids = snapshot.perfume_ids
+        hashes = snapshot.row_hashes
+        if edited_ids:
+            # Edited rows are dropped and encoded again together with the new ones
+            keep = ~np.isin(perfume_ids, edited_ids)
+            X, perfume_ids, votes, hashes = X[keep], perfume_ids[keep], votes[keep], hashes[keep]
+        if new_ids or edited_ids:
+            new_X, new_perfume_ids, new_votes, new_hashes = encode_rows(
+                get_dataset_df(perfume_ids=new_ids + edited_ids), snapshot.encoder())
+            X = sparse.vstack([X, new_X], format='csr')
+            perfume_ids = np.concatenate([perfume_ids, new_perfume_ids])
+            votes = np.concatenate([votes, new_votes])
+            hashes = np.concatenate([hashes, new_hashes])
+        if not new_ids and not edited_ids and not changed:
+            logger.info('Dataset snapshot is up to date')
+            return load_snapshot(directory, verify=False)
+        arrays = {'perfume_ids': perfume_ids, 'votes': votes, 'row_hashes': hashes,
+                  'data': X.data, 'indices': X.indices, 'indptr': X.indptr}
+        write_snapshot(arrays, snapshot.vocabulary, snapshot.manifest['built_rows'],
+                       snapshot.manifest.get('reencoded_rows', 0) + len(edited_ids), directory)
+    logger.info(f'Dataset snapshot updated in {time.perf_counter() - started:.2f}s: '
+                f'{len(new_ids)} rows appended, {len(edited_ids)} rows re-encoded, {changed} votes changed')
+    return load_snapshot(directory, verify=False)
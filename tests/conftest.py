@@ -0,0 +1,6 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# db creates its engine at import, the tests below never connect to it
+os.environ.setdefault('ca_string', 'sqlite://')
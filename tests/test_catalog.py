@@ -0,0 +1,30 @@
+import pandas as pd
+
+from catalog import CatalogService, SearchIndex
+
+
+def test_names_differing_only_in_case_stay_separate():
+    index = SearchIndex([(1, 'Oud, Brand'), (2, 'OUD, Brand'), (3, 'Rose Oud, Maison')])
+    assert len(index) == 3
+    assert index.search('oud')[0] == ['Oud, Brand', 'OUD, Brand', 'Rose Oud, Maison']
+    assert index.search('o')[0] == ['Oud, Brand', 'OUD, Brand']
+    assert index.search('')[0] == ['Oud, Brand', 'OUD, Brand', 'Rose Oud, Maison']
+
+
+def test_search_pages_and_typos():
+    index = SearchIndex((i, f'Perfume {i:02d}, Brand') for i in range(10))
+    page, more = index.search('perfume', offset=0, limit=4)
+    assert page == [f'Perfume {i:02d}, Brand' for i in range(4)] and more
+    assert index.search('perfume 0', offset=8, limit=4) == (['Perfume 08, Brand', 'Perfume 09, Brand'], False)
+    assert index.search('prefume 07')[0][0] == 'Perfume 07, Brand'
+
+
+def test_added_perfumes_are_searchable_by_id():
+    df = pd.DataFrame({'perfume_id': [1], 'perfume_nickname': ['oud-1'], 'perfume_name': ['Oud'],
+                       'perfume_url': ['/oud-1'], 'brand_id': ['b1'], 'brand_name': ['Brand'],
+                       'full_name': ['Oud, Brand']})
+    service = CatalogService(loader=lambda: df, ttl_seconds=float('inf'))
+    service.load()
+    service.add_perfumes([(2, 'oud-2', 'OUD', '/oud-2', 'b1'), (1, 'oud-1', 'Oud', '/oud-1', 'b1')])
+    assert service.search('oud')[0] == ['Oud, Brand', 'OUD, Brand']
+    assert service.get_perfume_id('OUD, Brand') == 2
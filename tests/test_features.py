@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+from xgboost import XGBClassifier
+
+from features import FeatureEncoder, check_model_features
+from model_registry import ModelRegistry
+
+
+FEATURES = ['rose', 'vanilla', 'woody']
+
+
+def test_models_with_another_feature_count_are_rejected():
+    encoder = FeatureEncoder.from_features(FEATURES)
+    model = RandomForestClassifier(n_estimators=2).fit(np.eye(4)[[0, 1, 2, 3]], [0, 1, 0, 1])
+    with pytest.raises(ValueError, match='expects 4 features'):
+        check_model_features('rf_model', model, encoder, FEATURES)
+
+
+def test_models_fitted_on_other_column_names_are_rejected():
+    encoder = FeatureEncoder.from_features(FEATURES)
+    df = pd.DataFrame(np.eye(3, dtype=int)[[0, 1, 2, 0]], columns=['vanilla', 'rose', 'woody'])
+    model = RandomForestClassifier(n_estimators=2).fit(df, [0, 1, 0, 1])
+    with pytest.raises(ValueError, match='differ from the published training features'):
+        check_model_features('rf_model', model, encoder, FEATURES)
+
+
+def test_xgb_fitted_on_a_dataframe_is_rejected():
+    encoder = FeatureEncoder.from_features(FEATURES)
+    df = pd.DataFrame(np.eye(3, dtype=int)[[0, 1, 2, 0]], columns=FEATURES)
+    model = XGBClassifier(n_estimators=2).fit(df, [0, 1, 0, 1])
+    with pytest.raises(ValueError, match='named DataFrame columns'):
+        check_model_features('xgb_model', model, encoder, FEATURES)
+
+
+def test_matching_sparse_models_pass():
+    encoder = FeatureEncoder.from_features(FEATURES)
+    X = np.eye(3, dtype=np.float32)[[0, 1, 2, 0]]
+    check_model_features('rf_model', RandomForestClassifier(n_estimators=2).fit(X, [0, 1, 0, 1]), encoder, FEATURES)
+    check_model_features('xgb_model', XGBClassifier(n_estimators=2).fit(X, [0, 1, 0, 1]), encoder, FEATURES)
+
+
+class PublishedDocument:
+    def __init__(self, document):
+        self.document = document
+
+    def find_one(self, query, projection=None):
+        return self.document
+
+
+def test_registry_requests_one_retrain_for_models_published_before_the_encoder():
+    rejected = []
+    registry = ModelRegistry()
+    registry._db = lambda: {'training_features': PublishedDocument(
+        {'list_name': 'scent_train', 'list_data': ['_ woody', '_ rose'], 'version': 'v1'})}
+    registry.add_rejection_listener(lambda version, reason: rejected.append(version))
+    for _ in range(2):
+        with pytest.raises(ValueError, match='full retrain is needed'):
+            registry.get()
+        registry.notify_published()
+    assert rejected == ['v1']
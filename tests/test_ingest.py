@@ -0,0 +1,30 @@
+import ingest
+from ingest import BatchWriter
+
+
+def perfume(perfume_id):
+    return perfume_id, ['Perfumer', 'woody', 'cedar', 4.0, 100, [(f'r{perfume_id}', 'Reviewer', 'Nice', None)]]
+
+
+def test_failed_batch_is_retried_perfume_by_perfume(monkeypatch):
+    calls = []
+    transient = {3: 1}
+
+    def bulk_insert(batches):
+        perfume_ids = [row[0] for row in batches['perfumes_data']]
+        calls.append(perfume_ids)
+        if 2 in perfume_ids:
+            raise ValueError('bad row')
+        if perfume_ids == [3] and transient[3]:
+            transient[3] -= 1
+            raise ValueError('connection reset')
+
+    monkeypatch.setattr(ingest, 'bulk_insert', bulk_insert)
+    writer = BatchWriter(batch_size=10, max_retries=2, backoff_seconds=0)
+    for perfume_id in (1, 2, 3):
+        writer.add(*perfume(perfume_id))
+    writer.flush()
+
+    assert sorted(writer.written) == [1, 3]
+    assert writer.failed == [2]
+    assert calls[0] == [1, 2, 3] and calls.count([2]) == 3 and calls.count([3]) == 2
@@ -0,0 +1,32 @@
+import main
+
+
+HITS = [{'dizajner': 'Dior', 'url': {'EN': ['https://www.example.com/perfume/Dior/Sauvage-Elixir-68415.html']}},
+        {'dizajner': 'Dior', 'url': {'EN': ['https://www.example.com/perfume/Dior/Sauvage-31861.html']}}]
+
+
+def catalog_parser(monkeypatch, catalog_after_forced_sync):
+    catalog = {31861}
+    syncs = []
+
+    def sync_brands(brands_data, force=False):
+        syncs.append(([brand[1] for brand in brands_data], force))
+        if force:
+            catalog.update(catalog_after_forced_sync)
+        return {'failed': [], 'skipped': [] if force else ['Dior']}
+
+    monkeypatch.setattr(main, 'search_perfumes', lambda perfume_name: HITS)
+    monkeypatch.setattr(main, 'sync_brands', sync_brands)
+    monkeypatch.setattr(main, 'get_catalog_perfume_ids', lambda brand_ids: set(catalog))
+    return syncs
+
+
+def test_perfume_missing_after_a_skipped_sync_forces_its_brand(monkeypatch):
+    syncs = catalog_parser(monkeypatch, {68415})
+    assert main.query_catalog_parser('Sauvage Elixir') is True
+    assert syncs == [(['Dior'], False), (['Dior'], True)]
+
+
+def test_perfume_missing_after_a_forced_sync_is_not_found(monkeypatch):
+    catalog_parser(monkeypatch, set())
+    assert main.query_catalog_parser('Sauvage Elixir') == 'empty'
@@ -0,0 +1,18 @@
+import types
+
+import proxies
+from proxies import ProxyPool
+
+
+def test_probe_counts_only_2xx_and_3xx_as_healthy(monkeypatch):
+    status_codes = {'http://ok:1': 200, 'http://redirect:1': 301, 'http://denied:1': 403, 'http://broken:1': 502}
+    monkeypatch.setattr(proxies, 'get_user_agent', lambda: 'test')
+    session = types.SimpleNamespace(get=lambda url, proxies, headers, timeout:
+                                    types.SimpleNamespace(status_code=status_codes[proxies['http']]))
+    pool = ProxyPool(lambda: list(status_codes), probe_url='http://example.com', probe_workers=2,
+                     session=lambda: session)
+    pool.refresh()
+    pool.probe()
+
+    assert sorted(pool.best(limit=10, probe=False)) == ['http://ok:1', 'http://redirect:1']
+    assert pool.get_stats()['http://denied:1']['failures'] == 1
@@ -0,0 +1,19 @@
+import pytest
+
+from review_tone import score_reviews
+
+
+@pytest.mark.parametrize('review, tone', [
+    ('I love it', True),
+    ("I don't love it", False),
+    ('I don’t love it', False),
+    ("It isn't good", False),
+    ("Can't recommend it", False),
+    ("Didn't disappoint, it wasn't boring at all", True),
+    ('Not bad at all', True),
+    ('Terrible headache', False),
+    ('It smells of roses', None),
+    (None, None),
+])
+def test_score_reviews(review, tone):
+    assert score_reviews([review]) == [tone]
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import snapshot
+
+
+@pytest.fixture
+def dataset(monkeypatch):
+    df = pd.DataFrame({
+        'perfume_id': [1, 2, 3, 4],
+        'perfume_name': ['Aqua', 'Bois', 'Cuir', 'Dune'],
+        'perfumer': ['Anne Flipo', 'Olivier Cresp', None, 'Anne Flipo'],
+        'brand_name': ['Dior', 'Chanel', 'Dior', 'Hermes'],
+        'notes': ['rose,musk', 'cedar,vetiver', 'leather,birch', 'sand,musk'],
+        'accords': ['floral', 'woody', 'leather', 'amber'],
+        'vote': [True, False, True, False],
+    })
+    monkeypatch.setattr(snapshot, 'get_dataset_df', lambda perfume_ids=None: df.copy() if perfume_ids is None
+                        else df[df['perfume_id'].isin(perfume_ids)].copy())
+    monkeypatch.setattr(snapshot, 'get_dataset_votes_df',
+                        lambda: df[['perfume_id', 'vote', 'perfumer', 'notes', 'accords', 'brand_name']].copy())
+    return df
+
+
+def rows_by_id(dataset):
+    vocabulary = dataset.vocabulary
+    return {int(perfume_id): ({vocabulary[j] for j in dataset.X[i].indices}, int(dataset.votes[i]))
+            for i, perfume_id in enumerate(dataset.perfume_ids)}
+
+
+def test_update_re_encodes_edited_perfumes_data_rows(dataset, tmp_path):
+    directory = str(tmp_path / 'snapshot')
+    snapshot.build_snapshot(directory)
+    dataset.loc[dataset['perfume_id'] == 2, 'notes'] = 'cedar,rose'
+    dataset.loc[dataset['perfume_id'] == 3, 'vote'] = False
+
+    updated = snapshot.update_snapshot(directory)
+
+    assert updated.manifest['reencoded_rows'] == 1
+    assert rows_by_id(updated) == rows_by_id(snapshot.build_snapshot(str(tmp_path / 'rebuilt')))
+
+
+def test_update_without_changes_keeps_the_snapshot(dataset, tmp_path):
+    directory = str(tmp_path / 'snapshot')
+    built = snapshot.build_snapshot(directory)
+    updated = snapshot.update_snapshot(directory)
+    assert updated.manifest['content_hash'] == built.manifest['content_hash']
+    assert updated.manifest['reencoded_rows'] == 0
+
+
+def test_load_rejects_a_snapshot_that_does_not_match_its_hash(dataset, tmp_path):
+    directory = str(tmp_path / 'snapshot')
+    snapshot.build_snapshot(directory)
+    votes = np.load(os.path.join(directory, 'votes.npy'))
+    np.save(os.path.join(directory, 'votes.npy'), 1 - votes)
+
+    assert snapshot.load_snapshot(directory) is None
+    assert rows_by_id(snapshot.update_snapshot(directory))[1][1] == 1
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from scipy import sparse
+from sklearn.ensemble import RandomForestClassifier
+from xgboost import XGBClassifier
+
+from get_prediction import forest_positive_proba, prediction_label, sklearn_forest
+from tree_engine import check_parity, compile_models, load_engine, write_engine
+
+
+@pytest.fixture(scope='module')
+def models():
+    rng = np.random.default_rng(0)
+    X = sparse.random(400, 60, density=0.1, format='csr', random_state=1, dtype=np.float32)
+    X.data[:] = rng.integers(1, 4, X.nnz)
+    y = (np.asarray(X[:, :5].sum(axis=1)).ravel() + rng.normal(0, 1, 400) > 2).astype(int)
+    rf_model = RandomForestClassifier(n_estimators=60, max_depth=8, random_state=0).fit(X, y)
+    xgb_model = XGBClassifier(n_estimators=30, max_depth=4).fit(X, y)
+    return rf_model, xgb_model, X
+
+
+@pytest.fixture(scope='module')
+def engine(models, tmp_path_factory):
+    rf_model, xgb_model, X = models
+    arrays, meta = compile_models(rf_model, xgb_model, X.shape[1], 'test')
+    return load_engine(write_engine(str(tmp_path_factory.mktemp('engine') / 'test.bin'), arrays, meta))
+
+
+def test_rf_probabilities_match_predict_proba(models, engine):
+    rf_model, _, X = models
+    np.testing.assert_allclose(engine.rf_positive_proba(X), rf_model.predict_proba(X)[:, 1], atol=1e-6)
+
+
+def test_xgb_probabilities_match_predict_proba(models, engine):
+    _, xgb_model, X = models
+    np.testing.assert_allclose(engine.xgb_positive_proba(X), xgb_model.predict_proba(X)[:, 1], atol=1e-6)
+
+
+def test_single_rows_match(models, engine):
+    rf_model, xgb_model, X = models
+    for row in range(5):
+        assert engine.rf_positive_proba(X[row])[0] == pytest.approx(rf_model.predict_proba(X[row])[0, 1], abs=1e-6)
+        assert engine.xgb_positive_proba(X[row])[0] == pytest.approx(xgb_model.predict_proba(X[row])[0, 1], abs=1e-6)
+
+
+def test_check_parity_passes(models, engine):
+    rf_model, xgb_model, X = models
+    differences = check_parity(engine, rf_model, xgb_model, X)
+    assert max(differences.values()) < 1e-6
+
+
+def test_early_exit_without_decisive_rows_scores_every_tree(models, engine):
+    rf_model, _, X = models
+    forest = engine.n_rf_trees, engine.rf_votes, engine.rf_positive_proba
+    probability, trees = forest_positive_proba(forest, X, lambda rows, low, high: np.zeros(len(rows), dtype=bool),
+                                               chunk_trees=10, min_trees=20)
+    np.testing.assert_allclose(probability, rf_model.predict_proba(X)[:, 1], atol=1e-6)
+    assert (trees == 60).all()
+
+
+def test_early_exit_matches_sklearn_forest(models, engine):
+    rf_model, _, X = models
+
+    def decisive(rows, low, high):
+        return prediction_label(low) == prediction_label(high)
+
+    engine_forest = engine.n_rf_trees, engine.rf_votes, engine.rf_positive_proba
+    engine_probability, engine_trees = forest_positive_proba(engine_forest, X, decisive, chunk_trees=10, min_trees=20)
+    sklearn_probability, sklearn_trees = forest_positive_proba(sklearn_forest(rf_model), X, decisive, chunk_trees=10,
+                                                               min_trees=20)
+    np.testing.assert_allclose(engine_probability, sklearn_probability, atol=1e-6)
+    np.testing.assert_array_equal(engine_trees, sklearn_trees)
+    assert (engine_trees < 60).any()
@@ -0,0 +1,114 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from models_training import train_model
+
+
+logger = logging.getLogger(__name__)
+
+
+training_debounce_seconds = float(os.getenv('training_debounce_seconds', 10))
+training_min_interval_seconds = float(os.getenv('training_min_interval_seconds', 60))
+training_max_delay_seconds = float(os.getenv('training_max_delay_seconds', 300))
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class TrainingScheduler:
+    def __init__(self, train=train_model, debounce_seconds=training_debounce_seconds,
+                 min_interval_seconds=training_min_interval_seconds, max_delay_seconds=training_max_delay_seconds):
+        self.train = train
+        self.debounce_seconds = debounce_seconds
+        self.min_interval_seconds = min_interval_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self._condition = threading.Condition()
+        self._worker = None
+        self._pending = None
+        self._running = None
+        self._last_finished = None
+        self._last_finished_monotonic = None
+        self._runs = 0
+        self._coalesced = 0
+
+    def request(self, reason='vote', mode='auto'):
+        with self._condition:
+            if self._pending is None:
+                self._pending = {'mode': mode, 'reasons': [reason], 'requests': 1, 'first_requested_at': _now(),
+                                 '_first_requested_monotonic': time.monotonic()}
+            else:
+                self._coalesced += 1
+                self._pending['requests'] += 1
+                if reason not in self._pending['reasons']:
+                    self._pending['reasons'].append(reason)
+                if mode == 'full':
+                    self._pending['mode'] = 'full'
+            self._pending['last_requested_at'] = _now()
+            self._pending['_last_requested_monotonic'] = time.monotonic()
+            logger.info(f'Training requested ({reason}, mode {mode}), {self._pending["requests"]} request(s) queued')
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='training-scheduler', daemon=True)
+                self._worker.start()
+            self._condition.notify()
+
+    def _seconds_until_due(self):
+        now = time.monotonic()
+        # A steady stream of votes must not postpone training forever
+        wait = min(self._pending['_last_requested_monotonic'] + self.debounce_seconds,
+                   self._pending['_first_requested_monotonic'] + self.max_delay_seconds) - now
+        if self._last_finished_monotonic is not None:
+            wait = max(wait, self._last_finished_monotonic + self.min_interval_seconds - now)
+        return wait
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                wait = self._seconds_until_due()
+                while wait > 0:
+                    self._condition.wait(timeout=wait)
+                    wait = self._seconds_until_due()
+                job = {key: value for key, value in self._pending.items() if not key.startswith('_')}
+                self._pending = None
+                self._running = dict(job, started_at=_now())
+
+            logger.info(f'Training job started: {job["requests"]} request(s) coalesced, mode {job["mode"]}')
+            started = time.perf_counter()
+            result = {'status': 'ok', 'error': None}
+            try:
+                self.train(mode=job['mode'])
+            except Exception as e:
+                logger.exception(f'Training job failed: {e}')
+                result = {'status': 'failed', 'error': str(e)}
+            duration = time.perf_counter() - started
+
+            with self._condition:
+                self._runs += 1
+                self._running = None
+                self._last_finished = dict(job, finished_at=_now(), duration=round(duration, 2), **result)
+                self._last_finished_monotonic = time.monotonic()
+            logger.info(f'Training job finished in {duration:.2f}s with status {result["status"]}')
+
+    def get_status(self):
+        with self._condition:
+            queued = {key: value for key, value in self._pending.items() if not key.startswith('_')} \
+                if self._pending else None
+            return {
+                'state': 'running' if self._running else 'queued' if queued else 'idle',
+                'queued': queued,
+                'running': self._running,
+                'last_finished': self._last_finished,
+                'runs': self._runs,
+                'coalesced_requests': self._coalesced,
+                'debounce_seconds': self.debounce_seconds,
+                'min_interval_seconds': self.min_interval_seconds,
+                'max_delay_seconds': self.max_delay_seconds,
+            }
+
+
+training_scheduler = TrainingScheduler()
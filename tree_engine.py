@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+
+logger = logging.getLogger(__name__)
+
+
+tree_engine_dir = os.getenv('tree_engine_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.tree_engine'))
+tree_engine_batch_elements = int(os.getenv('tree_engine_batch_elements', 2_000_000))
+tree_engine_parity_rows = int(os.getenv('tree_engine_parity_rows', 200))
+
+MAGIC = b'SCENTTE1'
+ALIGNMENT = 64
+NODE_ARRAYS = {'feature': np.int32, 'threshold': np.float64, 'left': np.int32, 'right': np.int32,
+               'default_left': np.bool_, 'value': np.float64}
+
+
+def _depth(left, right, roots):
+    depth = 0
+    level = np.asarray(roots)
+    while level.size:
+        level = level[left[level] >= 0]
+        level = np.concatenate([left[level], right[level]])
+        depth += 1
+    return depth
+
+
+def compile_forest(forest):
+    classes = list(forest.classes_)
+    nodes = {name: [] for name in NODE_ARRAYS}
+    roots = []
+    offset = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left < 0
+        value = tree.value[:, 0, :]
+        total = value.sum(axis=1)
+        nodes['feature'].append(np.where(is_leaf, -1, tree.feature))
+        nodes['threshold'].append(tree.threshold)
+        nodes['left'].append(np.where(is_leaf, -1, tree.children_left + offset))
+        nodes['right'].append(np.where(is_leaf, -1, tree.children_right + offset))
+        nodes['default_left'].append(np.zeros(tree.node_count, dtype=bool))
+        # Leaves hold the positive class share, the forest probability is their mean over trees
+        nodes['value'].append(value[:, classes.index(1)] / np.where(total > 0, total, 1)
+                              if 1 in classes else np.zeros(tree.node_count))
+        roots.append(offset)
+        offset += tree.node_count
+    arrays = {f'rf_{name}': np.concatenate(values).astype(NODE_ARRAYS[name]) for name, values in nodes.items()}
+    arrays['rf_roots'] = np.asarray(roots, dtype=np.int64)
+    return arrays, {'rf_depth': _depth(arrays['rf_left'], arrays['rf_right'], arrays['rf_roots'])}
+
+
+def _base_margin(booster):
+    config = json.loads(booster.save_config())
+    base_score = float(config['learner']['learner_model_param']['base_score'])
+    objective = config['learner']['objective']['name']
+    if objective.startswith('binary:logistic') or objective == 'reg:logistic':
+        return float(np.log(base_score / (1 - base_score)))
+    return base_score
+
+
+def compile_booster(booster):
+    feature_names = booster.feature_names
+    feature_index = {name: i for i, name in enumerate(feature_names)} if feature_names else None
+    nodes = {name: [] for name in NODE_ARRAYS}
+    roots = []
+    offset = 0
+    for dump in booster.get_dump(dump_format='json'):
+        tree = json.loads(dump)
+        flat = {}
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            flat[node['nodeid']] = node
+            stack.extend(node.get('children', []))
+        # XGBoost node ids are dense per tree, so they become offsets into the flat arrays directly
+        size = max(flat) + 1
+        feature = np.full(size, -1, dtype=np.int32)
+        threshold = np.zeros(size)
+        left = np.full(size, -1, dtype=np.int32)
+        right = np.full(size, -1, dtype=np.int32)
+        default_left = np.zeros(size, dtype=bool)
+        value = np.zeros(size)
+        for node_id, node in flat.items():
+            if 'leaf' in node:
+                value[node_id] = node['leaf']
+                continue
+            split = node['split']
+            feature[node_id] = feature_index[split] if feature_index else int(split[1:])
+            threshold[node_id] = np.float32(node['split_condition'])
+            left[node_id] = node['yes'] + offset
+            right[node_id] = node['no'] + offset
+            default_left[node_id] = node['missing'] == node['yes']
+        for name, values in zip(NODE_ARRAYS, [feature, threshold, left, right, default_left, value]):
+            nodes[name].append(values)
+        roots.append(offset)
+        offset += size
+    arrays = {f'xgb_{name}': np.concatenate(values).astype(NODE_ARRAYS[name]) for name, values in nodes.items()}
+    arrays['xgb_roots'] = np.asarray(roots, dtype=np.int64)
+    return arrays, {'xgb_depth': _depth(arrays['xgb_left'], arrays['xgb_right'], arrays['xgb_roots']),
+                    'xgb_base_margin': _base_margin(booster)}
+
+
+def write_engine(path, arrays, meta):
+    header = {'meta': meta, 'arrays': {}}
+    position = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': position}
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(MAGIC)
+            file.write(np.uint64(len(header_bytes)).tobytes())
+            file.write(header_bytes)
+            for name, array in arrays.items():
+                file.seek(data_start + header['arrays'][name]['offset'])
+                file.write(np.ascontiguousarray(array).tobytes())
+            file.truncate(data_start + position)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return path
+
+
+def load_engine(path):
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a compiled tree ensemble')
+        header_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(header_size))
+    data_start = -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        if not np.prod(spec['shape']):
+            arrays[name] = np.zeros(spec['shape'], dtype=np.dtype(spec['dtype']))
+            continue
+        arrays[name] = np.memmap(path, dtype=np.dtype(spec['dtype']), mode='r', offset=data_start + spec['offset'],
+                                 shape=tuple(spec['shape']))
+    return CompiledEnsemble(arrays, header['meta'])
+
+
+class CompiledEnsemble:
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+
+    @property
+    def n_rf_trees(self):
+        return len(self.arrays['rf_roots'])
+
+    def _dense_batches(self, X, trees):
+        X = sparse.csr_matrix(X, dtype=np.float32)
+        rows = max(1, tree_engine_batch_elements // max(trees, 1))
+        for start in range(0, X.shape[0], rows):
+            yield X[start:start + rows].toarray()
+
+    def _leaf_values(self, prefix, X, roots, depth, xgb):
+        feature = self.arrays[f'{prefix}_feature']
+        threshold = self.arrays[f'{prefix}_threshold']
+        left = self.arrays[f'{prefix}_left']
+        right = self.arrays[f'{prefix}_right']
+        default_left = self.arrays[f'{prefix}_default_left']
+        value = self.arrays[f'{prefix}_value']
+        results = []
+        for batch in self._dense_batches(X, len(roots)):
+            node = np.tile(roots, batch.shape[0])
+            row = np.repeat(np.arange(batch.shape[0]), len(roots))
+            active = np.arange(node.size)
+            # Only the (row, tree) pairs still on a split node move one level down in each step
+            for _ in range(depth):
+                active = active[feature[node[active]] >= 0]
+                if not active.size:
+                    break
+                current = node[active]
+                x = batch[row[active], feature[current]]
+                if xgb:
+                    # XGBoost sees the CSR input, where every absent entry is missing and follows the default branch
+                    go_left = np.where(x == 0, default_left[current], x < threshold[current])
+                else:
+                    go_left = x <= threshold[current]
+                node[active] = np.where(go_left, left[current], right[current])
+            results.append(value[node].reshape(batch.shape[0], len(roots)))
+        if not results:
+            return np.zeros((0, len(roots)))
+        return np.concatenate(results)
+
+    def rf_votes(self, X, start=0, stop=None):
+        roots = np.asarray(self.arrays['rf_roots'][start:stop])
+        return self._leaf_values('rf', X, roots, self.meta['rf_depth'], xgb=False)
+
+    def rf_positive_proba(self, X):
+        return self.rf_votes(X).mean(axis=1)
+
+    def xgb_positive_proba(self, X):
+        margin = self._leaf_values('xgb', X, np.asarray(self.arrays['xgb_roots']), self.meta['xgb_depth'],
+                                   xgb=True).sum(axis=1) + self.meta['xgb_base_margin']
+        return 1 / (1 + np.exp(-margin))
+
+
+def compile_models(rf_model, xgb_model, n_features, version=None):
+    rf_arrays, rf_meta = compile_forest(rf_model)
+    xgb_arrays, xgb_meta = compile_booster(xgb_model.get_booster())
+    if 1 not in list(xgb_model.classes_):
+        raise ValueError('XGBoost model has no positive class')
+    meta = dict(rf_meta, **xgb_meta, n_features=int(n_features), version=version)
+    return {**rf_arrays, **xgb_arrays}, meta
+
+
+def _positive_proba(model, X):
+    return model.predict_proba(X)[:, list(model.classes_).index(1)]
+
+
+def check_parity(engine, rf_model, xgb_model, X, atol=1e-5):
+    rf_expected = _positive_proba(rf_model, X) if 1 in list(rf_model.classes_) else np.zeros(X.shape[0])
+    xgb_expected = _positive_proba(xgb_model, X)
+    differences = {
+        'rf': float(np.abs(engine.rf_positive_proba(X) - rf_expected).max(initial=0)),
+        'xgb': float(np.abs(engine.xgb_positive_proba(X) - xgb_expected).max(initial=0)),
+    }
+    if max(differences.values()) > atol:
+        raise ValueError(f'Compiled trees do not match the models: {differences}')
+    return differences
+
+
+def engine_path(version, directory=tree_engine_dir):
+    return os.path.join(directory, f'{version}.bin')
+
+
+def export_engine(rf_model, xgb_model, X, version, directory=tree_engine_dir, parity_rows=tree_engine_parity_rows):
+    arrays, meta = compile_models(rf_model, xgb_model, X.shape[1], version)
+    path = write_engine(engine_path(version, directory), arrays, meta)
+    engine = load_engine(path)
+    differences = check_parity(engine, rf_model, xgb_model, X[:parity_rows])
+    logger.info(f'Compiled trees written to {path} ({os.path.getsize(path) / 2 ** 20:.1f} MB), '
+                f'max probability difference {differences}')
+    return path
+
+
+def remove_old_engines(keep_version, directory=tree_engine_dir):
+    if not os.path.isdir(directory):
+        return
+    # Versions are UTC timestamps, so only files of versions published before the kept one are removed
+    for name in os.listdir(directory):
+        if name.endswith('.bin') and name[:-len('.bin')] < str(keep_version):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass